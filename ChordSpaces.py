@@ -43,6 +43,93 @@ def searchRange(f, ranges):
     x0 = list(map(lambda x: x[0], ranges))
     return list(searchFrom(f, x0, ranges, []))
 
+# Pruned search of a range. The prefix predicate, fPre, is applied to
+# every partial chord (the first i voices) and must only return False
+# when no completion of that prefix can be accepted. A failing prefix
+# cuts off the whole subtree below it. The optional fFull predicate
+# is only applied to complete chords. Results are in the same order
+# as makeRange (last voice changes fastest), so searchRangePruned(p, r)
+# gives the same list as PTGG.filter(makeRange(r), p) for any p that
+# can be evaluated on prefixes.
+def searchRangePruned(fPre, ranges, fFull=None):
+    n = len(ranges)
+    xs = []
+    if n == 0:
+        return xs
+    x = []
+    stack = [0] # stack[i] is the next offset to try for voice i
+    while len(stack) > 0:
+        i = len(stack) - 1
+        v = ranges[i][0] + stack[i]
+        if v > ranges[i][1]: # voice i exhausted, backtrack
+            stack.pop()
+            if len(x) > 0:
+                x.pop()
+            continue
+        stack[i] += 1
+        x.append(v)
+        if not fPre(x):
+            x.pop()
+        elif i == n-1:
+            if fFull is None or fFull(x):
+                xs.append(list(x))
+            x.pop()
+        else:
+            stack.append(0)
+    return xs
+
+
+
+#=====================================================
+# PACKED CHORDS
+
+# Lists can't be hashed, so chords are packed into a single int for use
+# in sets and dictionaries. Each pitch takes 7 bits (MIDI range 0-127)
+# after a leading 1 bit that keeps the length, so [0] and [0,0] differ.
+
+PITCH_BITS = 7
+PITCH_MASK = (1 << PITCH_BITS) - 1
+
+def packChord(chord):
+    code = 1
+    for p in chord:
+        if p < 0 or p > PITCH_MASK:
+            raise Exception('Pitch '+str(p)+' cannot be packed (must be 0-127)')
+        code = (code << PITCH_BITS) | p
+    return code
+
+def unpackChord(code):
+    chord = []
+    while code > 1:
+        chord.append(code & PITCH_MASK)
+        code = code >> PITCH_BITS
+    chord.reverse()
+    return chord
+
+def chordSet(chords):
+    return set(map(packChord, chords))
+
+# Maps each packed chord to its first position in the list
+def chordIndex(chords):
+    index = {}
+    for i in range(len(chords)):
+        index.setdefault(packChord(chords[i]), i)
+    return index
+
+def hasChord(cSet, chord):
+    return packChord(chord) in cSet
+
+# Removes duplicate chords, keeping the first occurrence of each
+def dedupChords(chords):
+    seen = set()
+    res = []
+    for c in chords:
+        code = packChord(c)
+        if code not in seen:
+            seen.add(code)
+            res.append(c)
+    return res
+
 
 
 #=====================================================
@@ -155,30 +242,311 @@ def split(pred, items):
 def eqClass(eqRel,qSpace,x):
     return next((y for y in qSpace if eqRel(x,y[0])),None)
 
+#=====================================================
+# RANDOM ACCESS
+
+# Chords in a makeRange space can be addressed by their position
+# in the makeRange list without building the list. The last voice
+# changes fastest, just like itertools.product.
+
+def rangeSize(ranges):
+    n = 1
+    for r in ranges:
+        n = n * (r[1]-r[0]+1)
+    return n
+
+def rankChord(chord, ranges):
+    i = 0
+    for (v, r) in zip(chord, ranges):
+        if v < r[0] or v > r[1]:
+            raise Exception('Chord '+str(chord)+' is outside of the range '+str(ranges))
+        i = i * (r[1]-r[0]+1) + (v-r[0])
+    return i
+
+def unrankChord(i, ranges):
+    if i < 0 or i >= rangeSize(ranges):
+        raise Exception('Index '+str(i)+' is outside of the range '+str(ranges))
+    chord = []
+    for r in reversed(ranges):
+        w = r[1]-r[0]+1
+        chord.append(r[0] + i % w)
+        i = i // w
+    chord.reverse()
+    return chord
+
+# A filtered space is indexed by the sorted list of the makeRange ranks
+# of the chords that pass the filter. This is much smaller than the
+# chords themselves, and rank/unrank become a binary search/lookup.
+
+from bisect import bisect_left
+
+def indexRange(fPre, ranges, fFull=None):
+    chords = searchRangePruned(fPre, ranges, fFull)
+    return list(map(lambda c: rankChord(c, ranges), chords))
+
+def rankFiltered(chord, ranges, index):
+    r = rankChord(chord, ranges)
+    i = bisect_left(index, r)
+    if i == len(index) or index[i] != r:
+        raise Exception('Chord '+str(chord)+' is not in the filtered space')
+    return i
+
+def unrankFiltered(i, ranges, index):
+    return unrankChord(index[i], ranges)
+
+
 #=====================================================
 # RANDOMIZATION
 
+import random
 from random import seed, shuffle
 
 # The "randomize" function just becomes "shuffle"
 # Note: user has to choose in place or using a copy.
 # To return a list,x to its sorted order, use x.sort()
 
-def randomizeInPlace(items,rSeed):
-    seed(rSeed)
-    shuffle(items)
+# With a random.Random as rng, that generator is seeded and used
+# instead of the global one (rSeed=None leaves its state alone).
+
+def randomizeInPlace(items,rSeed,rng=None):
+    if rng is None:
+        seed(rSeed)
+        shuffle(items)
+    else:
+        if rSeed is not None:
+            rng.seed(rSeed)
+        rng.shuffle(items)
 
 # To maintain consistency with the Haskell version,
 # the main "randomize" definition copies the list rather
 # than sorting it in-place.
 
-def randomize(items,rSeed):
+def randomize(items,rSeed,rng=None):
     newItems = list(items)
-    randomizeInPlace(newItems, rSeed)
+    randomizeInPlace(newItems, rSeed, rng)
     return newItems
+
+# Lazy shuffling for spaces too big to hold in memory. randomPermutation
+# yields every number in [0,n) exactly once in a pseudo-random order
+# using a small Feistel network over the next power of 4 and cycle-walking
+# past values that are too big. Only the round keys are stored. The keys
+# are drawn from rng, which defaults to the global random module, but the
+# global seed is never changed.
+
+def randomPermutation(n, rng=None, rounds=4):
+    if rng is None:
+        rng = random
+    half = max(1, ((n-1).bit_length()+1) // 2)
+    mask = (1 << half) - 1
+    keys = [rng.getrandbits(32) for k in range(rounds)]
+    def roundFun(r, key):
+        h = ((r ^ key) * 0x9E3779B1 + key) & 0xFFFFFFFF
+        h = h ^ (h >> 15)
+        return (h * 0x85EBCA6B >> 7) & mask
+    def encrypt(x):
+        left = x >> half
+        right = x & mask
+        for key in keys:
+            left, right = right, left ^ roundFun(right, key)
+        return (left << half) | right
+    for i in range(n):
+        x = encrypt(i)
+        while x >= n:
+            x = encrypt(x)
+        yield x
+
+def shuffledRange(ranges, rng=None):
+    for i in randomPermutation(rangeSize(ranges), rng):
+        yield unrankChord(i, ranges)
+
+def shuffledFiltered(ranges, index, rng=None):
+    for i in randomPermutation(len(index), rng):
+        yield unrankChord(index[i], ranges)
+
+# Uniform sampling of k distinct chords without replacement.
+# random.sample works on a range without materializing it.
+
+def sampleRange(ranges, k, rng=None):
+    if rng is None:
+        rng = random
+    return [unrankChord(i, ranges) for i in rng.sample(range(rangeSize(ranges)), k)]
+
+def sampleFiltered(ranges, index, k, rng=None):
+    if rng is None:
+        rng = random
+    return [unrankChord(index[i], ranges) for i in rng.sample(range(len(index)), k)]
     
 
 
+#=====================================================
+# SHARED CHORD SPACES
+
+# A quotient space (list of classes of chords) can be published into
+# shared memory or a memory-mapped file once and attached to by name from
+# other processes, so that all workers read the same copy instead of each
+# rebuilding or unpickling their own. The layout is a header (magic,
+# number of chords, voices per chord, number of classes), the class start
+# offsets as int32s, and then one byte per pitch (MIDI range 0-127) with
+# the chords stored class by class. All chords must have the same number
+# of voices. Shared memory needs Python 3.8 or later.
+
+import struct
+import mmap
+
+SPACE_MAGIC = b'KCS1'
+SPACE_HEADER = struct.Struct('<4siii')
+
+def spaceBytes(qspace):
+    voices = len(qspace[0][0]) if len(qspace) > 0 and len(qspace[0]) > 0 else 0
+    offsets = [0]
+    pitches = []
+    for cls in qspace:
+        for c in cls:
+            if len(c) != voices:
+                raise Exception('All chords in a shared space need '+str(voices)+' voices: '+str(c))
+            pitches.extend(c)
+        offsets.append(offsets[-1] + len(cls))
+    for p in pitches:
+        if p < 0 or p > 127:
+            raise Exception('Pitch '+str(p)+' cannot be shared (must be 0-127)')
+    header = SPACE_HEADER.pack(SPACE_MAGIC, offsets[-1], voices, len(qspace))
+    return header + struct.pack('<'+str(len(offsets))+'i', *offsets) + bytes(bytearray(pitches))
+
+class SharedChordSpace:
+    def __init__(self, buf, owner=None):
+        self.owner = owner # the SharedMemory or mmap holding buf
+        self.buf = memoryview(buf)
+        (magic, self.numChords, self.voices, self.numClasses) = SPACE_HEADER.unpack_from(self.buf, 0)
+        if magic != SPACE_MAGIC:
+            raise Exception('Not a shared chord space')
+        start = SPACE_HEADER.size
+        end = start + 4 * (self.numClasses + 1)
+        self.offsets = self.buf[start:end].cast('i')
+        self.pitches = self.buf[end:end + self.numChords * self.voices]
+        self.views = {} # class number -> ChordClassView, see getClass
+
+    def chord(self, i):
+        return list(self.pitches[i * self.voices:(i + 1) * self.voices])
+
+    def classSize(self, j):
+        return self.offsets[j+1] - self.offsets[j]
+
+    def representative(self, j):
+        return self.chord(self.offsets[j])
+
+    # Classes are handed out as views that read their chords from the
+    # buffer when asked, so no process ends up with its own copy of the
+    # space. The same view is returned for repeated lookups of a class.
+    def getClass(self, j):
+        cls = self.views.get(j)
+        if cls is None:
+            cls = ChordClassView(self, self.offsets[j], self.offsets[j+1])
+            self.views[j] = cls
+        return cls
+
+    # Same as ChordSpaces.eqClass, but only reads one chord per class
+    def eqClass(self, eqRel, x):
+        for j in range(self.numClasses):
+            if self.classSize(j) > 0 and eqRel(x, self.representative(j)):
+                return self.getClass(j)
+        return None
+
+    # A SharedChordSpace can be used wherever a list of classes is expected
+    def __len__(self):
+        return self.numClasses
+    def __getitem__(self, j):
+        if j < 0:
+            j += self.numClasses
+        if j < 0 or j >= self.numClasses:
+            raise IndexError(j)
+        return self.getClass(j)
+    def __iter__(self):
+        for j in range(self.numClasses):
+            yield self.getClass(j)
+
+    def name(self):
+        return getattr(self.owner, 'name', None)
+
+    def close(self):
+        self.offsets.release()
+        self.pitches.release()
+        self.buf.release()
+        if self.owner is not None:
+            self.owner.close()
+
+    # Frees the shared memory. Only the publishing process should do this.
+    def unlink(self):
+        if hasattr(self.owner, 'unlink'):
+            self.owner.unlink()
+
+# A read-only class of a SharedChordSpace: chords first to end-1 of the
+# buffer. It can be used wherever a list of chords is expected, and each
+# chord is read as a new list when it is asked for. Views are pickled as
+# plain lists, since a worker that gets one by pickling has no buffer to
+# read from.
+class ChordClassView:
+    def __init__(self, space, first, end):
+        self.space = space
+        self.first = first
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.first
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.space.chord(self.first + k) for k in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError(i)
+        return self.space.chord(self.first + i)
+    def __iter__(self):
+        for i in range(self.first, self.end):
+            yield self.space.chord(i)
+    def __contains__(self, chord):
+        chord = list(chord)
+        return any(c == chord for c in self)
+
+    def index(self, chord):
+        chord = list(chord)
+        for k in range(len(self)):
+            if self.space.chord(self.first + k) == chord:
+                return k
+        raise ValueError(str(chord)+' is not in the class')
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+    def __ne__(self, other):
+        return not self == other
+    def __repr__(self):
+        return repr(list(self))
+    def __reduce__(self):
+        return (list, (list(self),))
+
+def publishSpace(qspace, name=None):
+    from multiprocessing import shared_memory
+    data = spaceBytes(qspace)
+    shm = shared_memory.SharedMemory(name=name, create=True, size=len(data))
+    shm.buf[:len(data)] = data
+    return SharedChordSpace(shm.buf[:len(data)], shm)
+
+def attachSpace(name):
+    from multiprocessing import shared_memory
+    shm = shared_memory.SharedMemory(name=name)
+    return SharedChordSpace(shm.buf, shm)
+
+def publishSpaceFile(qspace, filename):
+    with open(filename, 'wb') as f:
+        f.write(spaceBytes(qspace))
+    return attachSpaceFile(filename)
+
+def attachSpaceFile(filename):
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return SharedChordSpace(mm, mm)
+
+
+
 #=====================================================
 # TESTING
     
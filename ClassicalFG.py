@@ -5,11 +5,14 @@ import PTGG
 
 def pianoFilter(chords): # [[0, 1]]
     res = []
+    seen = set()
     for chd in chords:
         if not len(set(chd)) == len(chd):
             continue
         new_chd = sorted(chd)
-        if new_chd not in res:
+        code = ChordSpaces.packChord(new_chd)
+        if code not in seen:
+            seen.add(code)
             res.append(new_chd)
     return res
 
@@ -24,30 +27,75 @@ def testPred (a, b):
 def testPred2(a, b):
     return True
 
-def classicalCS2(tchords):
-    allChords = pianoFilter(ChordSpaces.makeRange([(47, 67), (52, 76), (60, 81)]))
+def classicalCS2(tchords, rng=None):
+    with Search.stage('chordSpace'):
+        allChords = pianoFilter(ChordSpaces.makeRange([(47, 67), (52, 76), (60, 81)]))
     #print("Total number of possible chords: ", len(allChords))
     # print(allChords[:10])
-    qSpace = ChordSpaces.partition(ChordSpaces.opEq, allChords)
+    with Search.stage('partition'):
+        qSpace = ChordSpaces.partition(ChordSpaces.opEq, allChords)
     # print(qSpace)
     chords = map(lambda x: x.absChord, tchords)
     # print(chords)
-    newChords = Search.greedyProg(qSpace, ChordSpaces.opEq, testPred, Search.nearFall, chords)
+    newChords = Search.greedyProg(qSpace, ChordSpaces.opEq, testPred, Search.NearFallback(rng=rng), chords, rng=rng)
     print(newChords)
     for i in range(len(tchords)):
         tchords[i].absChord = [] + newChords[i]
 
-def classicalCS2WithRange(tchords, voiceRange = [(47, 67), (52, 76), (60, 81)]):
+def classicalCS2WithRange(tchords, voiceRange = [(47, 67), (52, 76), (60, 81)], rng = None):
     #allChords = pianoFilter(ChordSpaces.makeRange(voiceRange))
-    allChords = PTGG.filter(ChordSpaces.makeRange(voiceRange), Constraints.satbFilter)
+    #allChords = PTGG.filter(ChordSpaces.makeRange(voiceRange), Constraints.satbFilter)
+    with Search.stage('chordSpace'):
+        allChords = ChordSpaces.searchRangePruned(Constraints.satbPrefixFilter, voiceRange, Constraints.satbFullFilter)
     #print("Total number of possible chords: ", len(allChords))
     # print(allChords[:10])
-    qSpace = ChordSpaces.partition(ChordSpaces.opcEq, allChords)
+    with Search.stage('partition'):
+        qSpace = ChordSpaces.partition(ChordSpaces.opcEq, allChords)
     print(qSpace)
     chords = map(lambda x: x.absChord, tchords)
-    newChords = Search.greedyProg(qSpace, ChordSpaces.opcEq, testPred, Search.nearFall, chords)
+    newChords = Search.greedyProg(qSpace, ChordSpaces.opcEq, testPred, Search.NearFallback(rng=rng), chords, rng=rng)
     #print("New Chords: ", newChords)
     print(newChords)
     for i in range(len(tchords)):
         tchords[i].absChord = [] + newChords[i]
 
+
+# Same as classicalCS2WithRange, but voices the progression in segments
+# of segLen chords in parallel (see Search.segmentedProg), minimizing the
+# Euclidean voice-leading distance within each segment.
+def classicalCS2Parallel(tchords, voiceRange = [(47, 67), (52, 76), (60, 81)], segLen = 16, processes = None):
+    with Search.stage('chordSpace'):
+        allChords = ChordSpaces.searchRangePruned(Constraints.satbPrefixFilter, voiceRange, Constraints.satbFullFilter)
+    with Search.stage('partition'):
+        qSpace = ChordSpaces.partition(ChordSpaces.opcEq, allChords)
+    chords = list(map(lambda x: x.absChord, tchords))
+    newChords = Search.segmentedProg(qSpace, ChordSpaces.opcEq, testPred, Constraints.euclideanDist, chords, segLen, None, processes)
+    if newChords is None:
+        raise Exception('error', 'No voicing satisfies the constraint')
+    for i in range(len(tchords)):
+        tchords[i].absChord = [] + newChords[i]
+
+# Incremental version of classicalCS2Parallel for editing: the chord space
+# is built once, and after replacing some of the TChords only the chords
+# around the edit are re-voiced (see Search.IncrementalProg).
+class IncrementalCS2:
+    def __init__(self, tchords, voiceRange = [(47, 67), (52, 76), (60, 81)], context = 2):
+        with Search.stage('chordSpace'):
+            allChords = ChordSpaces.searchRangePruned(Constraints.satbPrefixFilter, voiceRange, Constraints.satbFullFilter)
+        with Search.stage('partition'):
+            qSpace = ChordSpaces.partition(ChordSpaces.opcEq, allChords)
+        self.search = Search.IncrementalProg(qSpace, ChordSpaces.opcEq, testPred, Constraints.euclideanDist, context)
+        self.tchords = tchords
+        self.search.solve(list(map(lambda x: x.absChord, tchords)))
+        self.update(0, len(tchords))
+
+    # Copies the current solution into the TChords at positions lo to hi-1
+    def update(self, lo, hi):
+        for i in range(lo, hi):
+            self.tchords[i].absChord = [] + self.search.sol[i]
+
+    # Replaces tchords[lo:hi] with newTChords and re-voices around them
+    def replace(self, lo, hi, newTChords):
+        self.search.replace(lo, hi, list(map(lambda x: x.absChord, newTChords)))
+        self.tchords[lo:hi] = newTChords
+        self.update(self.search.window[0], self.search.window[1])
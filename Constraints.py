@@ -4,7 +4,7 @@ import sys
 from ChordSpaces import *
 
 def sorted(chord):
-    return all(chord[i] <= chord[i + 1] for i in xrange(len(chord) - 1))
+    return all(chord[i] <= chord[i + 1] for i in range(len(chord) - 1))
 
 def spaced(lims, chord):
     cPairs = zip(chord[0:len(chord)-2], chord[1:])
@@ -23,16 +23,62 @@ triads = [[0, 0, 4, 7], [0, 4, 7, 7], [0, 0, 3, 7], [0, 3, 7, 7], [0, 0, 3, 6]]
 def flatten(x):
     return [val for sublist in x for val in sublist]
 
+# The normalized, transposed templates only depend on the templates, so
+# they are built once per template list and kept as a set of packed
+# chords (see ChordSpaces.packChord).
+doubledTables = {}
+
+def doubledTable(templates):
+    key = tuple(map(tuple, templates))
+    table = doubledTables.get(key)
+    if table is None:
+        allTriads = flatten(map(lambda c: map(lambda v: normOP(t(v,c)), templates), range(0,12)))
+        table = frozenset(map(packChord, allTriads))
+        doubledTables[key] = table
+    return table
+
 def doubled(templates, x):
-    allTriads = flatten(map(lambda c: map(lambda v: normOP(t(v,c)), templates), range(0,12)))
-    xn = normOP(x)
-    return xn in allTriads
+    return packChord(normOP(x)) in doubledTable(templates)
 
 
 # satbFilter x = and $ map ($x) [sorted, spaced satbLimits, doubled triads]
 satbLimits = [(3,12), (3,12), (3,12), (3,12)]
 def satbFilter(x): return sorted(x) and doubled(triads,x) and spaced(satbLimits,x)
 
+# The parts of satbFilter that can be checked on the first few voices of
+# a chord, for use with ChordSpaces.searchRangePruned. Doubling can only
+# be checked on complete chords.
+def satbPrefixFilter(x): return sorted(x) and spaced(satbLimits,x)
+def satbFullFilter(x): return doubled(triads,x)
+
+# Batch version of satbFilter: returns one boolean per chord. The
+# sortedness, spacing and doubling checks are done inline in a single
+# pass with the doubling table looked up once, rather than going
+# through three function calls per chord.
+def satbFilterBatch(chords, templates=triads, lims=satbLimits):
+    table = doubledTable(templates)
+    mask = []
+    for x in chords:
+        n = len(x)
+        ok = True
+        for i in range(n-1):
+            if x[i] > x[i+1]:
+                ok = False
+                break
+        if ok: # same pairs as spaced: the first n-2 adjacent pairs
+            for i in range(min(n-2, len(lims))):
+                diff = abs(x[i+1] - x[i])
+                if diff < lims[i][0] or diff > lims[i][1]:
+                    ok = False
+                    break
+        if ok:
+            ok = packChord(normOP(x)) in table
+        mask.append(ok)
+    return mask
+
+def satbFilterAll(chords):
+    return [x for (x, ok) in zip(chords, satbFilterBatch(chords)) if ok]
+
 # check if parrallel exist
 def hNotPar1(chord1, chord2):
     if not len(chord1) == len(chord2):
@@ -46,21 +92,222 @@ def hNotCross(chord1, chord2):
     if not len(chord1) == len(chord2):
         print("the length of chords are different!")
         return True #???
-    rank1 = sorted(range(len(chord1)), key=lambda k: chord1[k])
-    rank2 = sorted(range(len(chord2)), key=lambda k: chord2[k])
-    return rank1 == rank2
+    return rankOrder(chord1) == rankOrder(chord2)
+
+# Two chords have the same (stable) voice ranking exactly when every pair
+# of voices i<j compares the same way in both, so the ranking is encoded
+# as one bit per voice pair. This avoids sorting on every comparison.
+def rankOrder(chord):
+    code = 0
+    n = len(chord)
+    for i in range(n):
+        for j in range(i+1, n):
+            code = (code << 1) | (chord[i] <= chord[j])
+    return code
 
 def euclideanDist(chord1, chord2):
     if not len(chord1) == len(chord2):
         print("the length of chords are different!")
-        return sys.maxint
+        return sys.maxsize
     return math.sqrt(sum((a - b) ** 2 for a,b in zip(chord1, chord2)))
 
 def maxStepDist(chord1, chord2):
     if not len(chord1) == len(chord2):
         print("the length of chords are different!")
-        return sys.maxint
+        return sys.maxsize
     return max(abs(a - b) for a, b in zip(chord1, chord2))
+
+# BATCH VOICE-LEADING KERNELS
+# The *Row functions compare one chord against a whole list of chords
+# (for example, a candidate class) and return one value per chord. The
+# *Matrix functions return rows[i][j] for chords1[i] against chords2[j].
+# Chords of different lengths get the same values as the pairwise
+# functions (True or sys.maxsize) without the warning message.
+
+def hNotPar1Row(chord, chords):
+    n = len(chord)
+    res = []
+    for c in chords:
+        if len(c) != n:
+            res.append(True)
+        else:
+            res.append(len(set([a - b for (a, b) in zip(chord, c)])) == n)
+    return res
+
+def hNotCrossRow(chord, chords, orders=None):
+    if orders is None:
+        orders = list(map(rankOrder, chords))
+    n = len(chord)
+    r = rankOrder(chord)
+    return [len(c) != n or o == r for (c, o) in zip(chords, orders)]
+
+def euclideanDistRow(chord, chords):
+    n = len(chord)
+    res = []
+    for c in chords:
+        if len(c) != n:
+            res.append(sys.maxsize)
+        else:
+            res.append(math.sqrt(sum([(a - b) ** 2 for (a, b) in zip(chord, c)])))
+    return res
+
+def maxStepDistRow(chord, chords):
+    n = len(chord)
+    res = []
+    for c in chords:
+        if len(c) != n:
+            res.append(sys.maxsize)
+        else:
+            res.append(max([abs(a - b) for (a, b) in zip(chord, c)]))
+    return res
+
+def hNotPar1Matrix(chords1, chords2):
+    return [hNotPar1Row(c, chords2) for c in chords1]
+
+def hNotCrossMatrix(chords1, chords2):
+    orders = list(map(rankOrder, chords2)) # computed once for all rows
+    return [hNotCrossRow(c, chords2, orders) for c in chords1]
+
+def euclideanDistMatrix(chords1, chords2):
+    return [euclideanDistRow(c, chords2) for c in chords1]
+
+def maxStepDistMatrix(chords1, chords2):
+    return [maxStepDistRow(c, chords2) for c in chords1]
+
+# Any other pairwise function can be applied the same way.
+def pairRow(f, chord, chords):
+    return [f(chord, c) for c in chords]
+
+def pairMatrix(f, chords1, chords2):
+    return [pairRow(f, c, chords2) for c in chords1]
+
+# CONSTRAINT SETS
+# A Constraint wraps a predicate along with what kind of predicate it is
+# and, optionally, its cost (seconds per call) and selectivity (fraction
+# of inputs that pass). The kinds are:
+#
+# - UNARY: f(chord), only meaningful on complete chords
+# - PREFIX: f(chord) that can also be applied to the first few voices of
+#   a chord (see ChordSpaces.searchRangePruned)
+# - PAIR: f(chord1, chord2) for voice-leading between adjacent chords
+#
+# A batch function (chords -> list of booleans, like satbFilterBatch) can
+# be given for UNARY and PREFIX constraints and is used by filterBatch.
+#
+# A ConstraintSet orders its constraints so that the cheapest, most
+# selective checks run first. For independent checks, running them in
+# increasing order of cost/(1-selectivity) minimizes the expected cost.
+# Costs and selectivities can be declared or measured on sample data.
+
+import time
+
+UNARY = "unary"
+PREFIX = "prefix"
+PAIR = "pair"
+
+class Constraint:
+    def __init__(self, fn, kind=UNARY, cost=None, selectivity=None, batch=None, name=None):
+        self.fn = fn
+        self.kind = kind
+        self.cost = cost
+        self.selectivity = selectivity
+        self.batch = batch
+        self.name = name if name is not None else getattr(fn, '__name__', 'constraint')
+    def rank(self):
+        cost = self.cost if self.cost is not None else 1.0
+        sel = self.selectivity if self.selectivity is not None else 0.5
+        if sel >= 1.0: # never rejects anything, so it should go last
+            return float('inf')
+        return cost / (1.0 - sel)
+    def __str__(self):
+        return self.kind+" "+self.name+" (cost="+str(self.cost)+", selectivity="+str(self.selectivity)+")"
+    def __repr__(self):
+        return str(self)
+
+class ConstraintSet:
+    def __init__(self, constraints):
+        self.constraints = list(constraints)
+
+    def ofKind(self, kinds):
+        cs = [c for c in self.constraints if c.kind in kinds]
+        cs.sort(key=lambda c: c.rank()) # stable, so ties keep the given order
+        return cs
+
+    # Measures cost and selectivity on sample data: chords for UNARY and
+    # PREFIX constraints and (chord1, chord2) tuples for PAIR constraints.
+    def measure(self, samples=None, pairSamples=None):
+        for c in self.constraints:
+            xs = pairSamples if c.kind == PAIR else samples
+            if xs is None or len(xs) == 0:
+                continue
+            passed = 0
+            t0 = time.time()
+            if c.kind == PAIR:
+                for (a, b) in xs:
+                    if c.fn(a, b):
+                        passed += 1
+            else:
+                for x in xs:
+                    if c.fn(x):
+                        passed += 1
+            c.cost = (time.time() - t0) / len(xs)
+            c.selectivity = float(passed) / len(xs)
+        return self
+
+    # Short-circuiting evaluators for the different kinds of searches.
+    def compileUnary(self):
+        return andAll(tuple(c.fn for c in self.ofKind([PREFIX, UNARY])))
+
+    def compilePrefix(self):
+        return andAll(tuple(c.fn for c in self.ofKind([PREFIX])))
+
+    def compileFull(self): # the checks a prefix search still needs at the end
+        return andAll(tuple(c.fn for c in self.ofKind([UNARY])))
+
+    def compilePair(self):
+        fns = tuple(c.fn for c in self.ofKind([PAIR]))
+        def f(a, b):
+            for g in fns:
+                if not g(a, b):
+                    return False
+            return True
+        return f
+
+    # Uses searchRangePruned with the PREFIX constraints for pruning.
+    def searchRange(self, ranges):
+        return searchRangePruned(self.compilePrefix(), ranges, self.compileFull())
+
+    # Filters a list of chords one constraint at a time, only passing the
+    # survivors of each step to the next one and using batch functions
+    # where available.
+    def filterBatch(self, chords):
+        xs = list(chords)
+        for c in self.ofKind([PREFIX, UNARY]):
+            if len(xs) == 0:
+                break
+            if c.batch is not None:
+                mask = c.batch(xs)
+            else:
+                mask = list(map(c.fn, xs))
+            xs = [x for (x, ok) in zip(xs, mask) if ok]
+        return xs
+
+def andAll(fns):
+    def f(x):
+        for g in fns:
+            if not g(x):
+                return False
+        return True
+    return f
+
+# satbFilter as a constraint set. The costs and selectivities are rough
+# values measured on the four-voice range used in Examples.py.
+satbConstraints = ConstraintSet([
+    Constraint(sorted, PREFIX, 1.5e-6, 0.34),
+    Constraint(lambda x: spaced(satbLimits, x), PREFIX, 1.8e-6, 0.31, name="spaced"),
+    Constraint(satbFullFilter, UNARY, 2.4e-6, 0.03, name="doubled")])
+
+
 # parameters
 # dist function, constraints, chord1, chrod2
 def distClass(distFun, predicate, chord1, chord2):
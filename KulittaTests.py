@@ -2,8 +2,11 @@
 # Wen Sheng
 # Last modified: 13-April-2016
 # ===================================
+import random
 import Search
 import Constraints
+import ChordSpaces
+import PythonEuterpea
 
 # test pitch case a, b is same
 def testEq (a, b):
@@ -37,4 +40,183 @@ print Search.pairProg(testSpace, testEq, testPred, testMel)
 #     else:
 #         return (g, bucket[0])
 print "greedyProg"
-print Search.greedyProg(testSpace, testEq, testPred, Search.nearFall, testMel)
\ No newline at end of file
+print Search.greedyProg(testSpace, testEq, testPred, Search.nearFall, testMel)
+
+
+# ============Testing the other progression searches against pairProg============
+
+def testCost (a, b):
+    return abs(a - b)
+
+testSols = Search.pairProg(testSpace, testEq, testPred, testMel)
+testBest = min([Search.progCost(sol, testCost) for sol in testSols])
+
+print "optimalProg cost"
+print "expected:", testBest
+print Search.progCost(Search.optimalProg(testSpace, testEq, testPred, testCost, testMel), testCost)
+
+print "beamProg cost with a beam as wide as the classes"
+print "expected:", testBest
+print Search.progCost(Search.beamProg(testSpace, testEq, testPred, testCost, testMel, 2), testCost)
+
+print "anytimeProg cost and whether it is known to be optimal"
+print "expected:", testBest, True
+testAnytime = Search.anytimeProg(testSpace, testEq, testPred, testCost, testMel, 5.0, random.Random(0))
+print testAnytime.cost, testAnytime.optimal
+
+print "countPairProg, iterPairProg and cached/pruned pairProg against pairProg"
+print "expected:", len(testSols), True, True, True
+testCache = Search.TransitionCache()
+print Search.countPairProg(testSpace, testEq, testPred, testMel), \
+    sorted(Search.iterPairProg(testSpace, testEq, testPred, testMel)) == sorted(testSols), \
+    sorted(Search.pairProg(testSpace, testEq, testPred, testMel, cache=testCache)) == sorted(testSols), \
+    sorted(Search.pairProg(testSpace, testEq, testPred, testMel, prune=True)) == sorted(testSols)
+
+print "sampleProgs only returns solutions"
+print "expected: True"
+print all([sol in testSols for sol in Search.sampleProgs(testSpace, testEq, testPred, testMel, 20, random.Random(0))])
+
+def satisfies(sol, pred):
+    return all([pred(sol[i], sol[i+1]) for i in range(len(sol) - 1)])
+
+print "minConflictsProg: violations left and whether the result satisfies the constraint"
+print "expected: [] True"
+(testRepaired, testViolated) = Search.minConflictsProg(testSpace, testEq, testPred, testMel, rng=random.Random(0))
+print testViolated, satisfies(testRepaired, testPred)
+
+testLongMel = testMel * 5
+print "segmentedProg: length and whether the result satisfies the constraint"
+print "expected:", len(testLongMel), True
+testSegmented = Search.segmentedProg(testSpace, testEq, testPred, testCost, testLongMel, 4, None, 1)
+print len(testSegmented), satisfies(testSegmented, testPred)
+
+print "IncrementalProg after an edit: pitch classes and whether the result satisfies the constraint"
+testEdited = testLongMel[:5] + [9, 5] + testLongMel[6:]
+print "expected:", testEdited, True
+testIncremental = Search.IncrementalProg(testSpace, testEq, testPred, testCost)
+testIncremental.solve(testLongMel)
+testIncremental.replace(5, 6, [9, 5])
+print [p % 12 for p in testIncremental.sol], satisfies(testIncremental.sol, testPred)
+
+
+# ============Testing chord space construction and indexing============
+
+satbRange = [(40, 52), (47, 59), (52, 64), (57, 69)]
+satbChords = [c for c in ChordSpaces.makeRange(satbRange) if Constraints.satbFilter(c)]
+
+print "searchRangePruned against filtering makeRange"
+print "expected: True"
+print ChordSpaces.searchRangePruned(Constraints.satbPrefixFilter, satbRange, Constraints.satbFullFilter) == satbChords
+
+smallRange = [(0, 2), (3, 6), (1, 2)]
+smallChords = ChordSpaces.makeRange(smallRange)
+print "rankChord and unrankChord against makeRange order"
+print "expected: True True"
+print [ChordSpaces.rankChord(c, smallRange) for c in smallChords] == list(range(len(smallChords))), \
+    [ChordSpaces.unrankChord(i, smallRange) for i in range(len(smallChords))] == smallChords
+
+satbIndex = ChordSpaces.indexRange(Constraints.satbPrefixFilter, satbRange, Constraints.satbFullFilter)
+print "rankFiltered and unrankFiltered against the filtered list"
+print "expected: True True"
+print [ChordSpaces.rankFiltered(c, satbRange, satbIndex) for c in satbChords] == list(range(len(satbChords))), \
+    [ChordSpaces.unrankFiltered(i, satbRange, satbIndex) for i in range(len(satbChords))] == satbChords
+
+print "packChord/unpackChord and dedupChords"
+print "expected: True", len(satbChords)
+print all([ChordSpaces.unpackChord(ChordSpaces.packChord(c)) == c for c in satbChords]), \
+    len(ChordSpaces.dedupChords(satbChords + satbChords))
+
+# the nearest voicing may be any of several at the same distance
+print "NearestIndex distance against a linear scan"
+print "expected: True"
+testRng = random.Random(0)
+testIndex = Search.NearestIndex(satbChords)
+testQueries = [[testRng.randint(35, 75) for v in range(4)] for i in range(200)]
+print all([Constraints.euclideanDist(q, testIndex.nearest(q)) == min([Constraints.euclideanDist(q, c) for c in satbChords]) for q in testQueries])
+
+
+# ============Testing applyTempo on shared subtrees============
+
+# the same Note object is used twice, so both paths must be scaled once
+sharedNote = PythonEuterpea.Note(60, 0.5)
+sharedTempo = PythonEuterpea.applyTempo(PythonEuterpea.Modify(PythonEuterpea.Tempo(2), PythonEuterpea.line([sharedNote, sharedNote])))
+print "applyTempo on a shared subtree"
+print "expected: 0.5 0.5"
+print PythonEuterpea.dur(sharedTempo), sharedNote.dur
+
+
+# ============Testing PythonEuterpea traversals with and without recursion============
+
+# A random music tree, with some subtrees shared between several parents
+def randomMusic(rng, depth, pool):
+    if pool and rng.random() < 0.1:
+        return rng.choice(pool)
+    k = rng.random()
+    if depth == 0 or k < 0.3:
+        if rng.random() < 0.8:
+            x = PythonEuterpea.Note(rng.randint(40, 80), rng.choice([0, 0.125, 0.25, 0.5, 1/3.0]), rng.randint(1, 120))
+        else:
+            x = PythonEuterpea.Rest(rng.choice([0, 0.25, 0.5]))
+    elif k < 0.55:
+        x = PythonEuterpea.Seq(randomMusic(rng, depth-1, pool), randomMusic(rng, depth-1, pool))
+    elif k < 0.8:
+        x = PythonEuterpea.Par(randomMusic(rng, depth-1, pool), randomMusic(rng, depth-1, pool))
+    elif k < 0.9:
+        x = PythonEuterpea.Modify(PythonEuterpea.Tempo(rng.choice([0.5, 1.5, 2.0])), randomMusic(rng, depth-1, pool))
+    else:
+        x = PythonEuterpea.Modify(PythonEuterpea.Instrument(rng.randint(0, 100)), randomMusic(rng, depth-1, pool))
+    pool.append(x)
+    return x
+
+def testMusic(seed):
+    rng = random.Random(seed)
+    x = randomMusic(rng, 7, [])
+    if rng.random() < 0.3:
+        x = PythonEuterpea.Music(x, rng.choice([40, 60, 120]))
+    return x
+
+def pitchList(x):
+    return PythonEuterpea.mFold(x, lambda n: [n.pitch], lambda r: [], lambda a, b: a + b, lambda a, b: a + b, lambda m, v: v)
+
+traversals = [('dur', lambda x: PythonEuterpea.dur(x)),
+              ('dur with a cache', lambda x: PythonEuterpea.dur(x, PythonEuterpea.newDurCache())),
+              ('tempoDur', lambda x: PythonEuterpea.tempoDur(x, 1.5, PythonEuterpea.newDurCache())),
+              ('hasSharing', PythonEuterpea.hasSharing),
+              ('mMap', lambda x: PythonEuterpea.transpose(x, 3)),
+              ('mMapAll', lambda x: PythonEuterpea.scaleDurations(x, 2)),
+              ('reverse', PythonEuterpea.reverse),
+              ('cut', lambda x: PythonEuterpea.cut(x, 1.3)),
+              ('remove', lambda x: PythonEuterpea.remove(x, 0.9)),
+              ('mFold', pitchList),
+              ('firstPitch', PythonEuterpea.firstPitch),
+              ('removeInstruments', PythonEuterpea.removeInstruments),
+              ('applyTempo', PythonEuterpea.applyTempo),
+              ('musicToMEvents', PythonEuterpea.musicToMEvents),
+              ('removeZeros', PythonEuterpea.removeZeros)]
+
+# Each traversal gets a new tree, since some of them change it in place
+def traversalResults(seed):
+    res = []
+    for (name, f) in traversals:
+        x = testMusic(seed)
+        res.append(str(f(x)) + ' ' + str(x))
+    return res
+
+# With maxDepth at 0, every traversal is done by walk
+differ = set()
+for seed in range(100):
+    PythonEuterpea.maxDepth = 200
+    recursive = traversalResults(seed)
+    PythonEuterpea.maxDepth = 0
+    walked = traversalResults(seed)
+    for i in range(len(traversals)):
+        if recursive[i] != walked[i]:
+            differ.add(traversals[i][0])
+PythonEuterpea.maxDepth = 200
+print "traversals that differ when walk does everything"
+print "expected: []"
+print sorted(differ)
+
+print "dur of a line too deep to recurse through"
+print "expected: 1250.0"
+print PythonEuterpea.dur(PythonEuterpea.line([PythonEuterpea.Note(60, 0.25) for i in range(5000)]))
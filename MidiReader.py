@@ -134,7 +134,7 @@ def mEventsToMusic(mevs):
         n = Note(e.pitch, e.dur, e.vol)
         r = Rest(e.eTime)
         mVals.append(line([r,n]))
-    mTotal = chord(mVals)
+    mTotal = balancedChord(mVals) # one Par per note, so keep it shallow
     if (patch[0] >= 0):
         i = Instrument(patch[0], patch[1])
         print "Instrument: ", i
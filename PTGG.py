@@ -38,6 +38,23 @@ class Var:
     def __repr__(self):
         return str(self)
 
+# Dispatch tables for walking over sequences of symbols. Each table
+# maps a symbol's class to the function that handles it, so a symbol
+# costs one dict lookup instead of a chain of class name comparisons.
+# Classes are matched by name the first time they are seen, as the
+# name comparisons did, and anything else is reported as before.
+class Dispatch(dict):
+    def __init__(self, handlers):
+        dict.__init__(self)
+        self.handlers = handlers
+    def __missing__(self, cls):
+        f = self.handlers.get(cls.__name__, unrecognized)
+        self[cls] = f
+        return f
+
+def unrecognized(x, *args):
+    raise Exception("Unrecognized symbol: " + str(x)+"Type: "+type(x).__class__.__name__)
+
 
 
 # This version of applyRule assumes that we have already
@@ -55,11 +72,15 @@ def applyRuleP(r,sym):
 # For choose(xs), we assume that xs is a list of tuples.
 # The first element in each tuple is the probability. We
 # assume that probabilities sum to 1.0.
+# The optional rng (a random.Random) is used instead of the
+# global random module, so that generation in several threads
+# can be reproducible for each seed. The same goes for update
+# and gen below.
 
-def choose(xs):
+def choose(xs, rng=None):
     n = len(xs)
     if n> 0: # Do we have things to choose from?
-        r = random() # in [0.0, 1.0)
+        r = random() if rng is None else rng.random() # in [0.0, 1.0)
         i = 0
         while i < n: # Search through the items
             p = xs[i][0]
@@ -95,37 +116,41 @@ def findRulesP(prules,x): # assumes rules have form (p,(lhs,rhs))
 # Update function to apply rules left to right over
 # a sequence of symbols.
 
-def update(prules, seq):
+def update(prules, seq, rng=None):
     newSeq = [] # new sequence
     for x in seq: # update each symbol in the sequence
-        if (x.__class__.__name__ == 'Var'):
-            newSeq.append(x)
-        elif (x.__class__.__name__ == 'Let'):
-            newVal = update(prules, x.val)
-            newExp = update(prules, x.exp)
-            newSeq = [Let(x.x, newVal, newExp)]
-        elif (x.__class__.__name__ == 'NT'):
-            okRs = findRulesP(prules, x.val[0]) # which rules can we use?
-            if len(okRs) > 0: # did we find any rules?
-                r = choose(okRs) # pick a rule stochastically
-                newX = applyRule(r,x.val) # apply the rule
-                # print(newSeq)
-                # print(type(list(newX)))
-                newSeq = newSeq+newX # grow the new sequence
-            else: # no rules available - symbol is a terminal.
-                newSeq.append(x)
-        else:
-            raise Exception("Unrecognized symbol: " + str(x)+"Type: "+type(x).__class__.__name__)
+        newSeq = updateTable[x.__class__](x, newSeq, prules, rng)
+    return newSeq
+
+def updateVar(x, newSeq, prules, rng):
+    newSeq.append(x)
+    return newSeq
+
+def updateLet(x, newSeq, prules, rng):
+    newVal = update(prules, x.val, rng)
+    newExp = update(prules, x.exp, rng)
+    return [Let(x.x, newVal, newExp)]
+
+def updateNT(x, newSeq, prules, rng):
+    okRs = findRulesP(prules, x.val[0]) # which rules can we use?
+    if len(okRs) > 0: # did we find any rules?
+        r = choose(okRs, rng) # pick a rule stochastically
+        newX = applyRule(r,x.val) # apply the rule
+        newSeq.extend(newX) # grow the new sequence
+    else: # no rules available - symbol is a terminal.
+        newSeq.append(x)
     return newSeq
 
+updateTable = Dispatch({'Var': updateVar, 'Let': updateLet, 'NT': updateNT})
+
 # The gen function for n iterations
 
-def gen(prules, seq, n):
+def gen(prules, seq, n, rng=None):
     if n<=0: # are we done?
         return seq
     else: # not done, so generate one more level
-        newSeq = update(prules, seq)
-        return gen(prules, newSeq, n-1)
+        newSeq = update(prules, seq, rng)
+        return gen(prules, newSeq, n-1, rng)
 
 # Wraps a list of pairs with the NT constructor.
 def toNT(seq):
@@ -138,20 +163,24 @@ def toNT(seq):
 def expand(env, seq):
     newSeq = [] # create a new local sequence to build
     for x in seq:
-        if (x.__class__.__name__ == 'Var'): 
-            xVal = lookupLast(env,x.name) # find variable definition
-            newSeq = newSeq +xVal # add its definition to the new sequence
-        elif (x.__class__.__name__ == 'Let'):
-            env.append((x.x, x.val)) # add x's definition
-            newXs = expand(env,x.exp) # recurse into the expression
-            newSeq = newSeq+newXs # add result to new sequence
-            env.pop() # remove x's definition
-        elif (x.__class__.__name__ == 'NT'):
-            newSeq.append(x) # just add the symbol
-        else: 
-            raise Exception("Unrecognized symbol: " + str(x)+"Type: "+type(x).__class__.__name__)
+        expandTable[x.__class__](x, newSeq, env)
     return newSeq
 
+def expandVar(x, newSeq, env):
+    xVal = lookupLast(env,x.name) # find variable definition
+    newSeq.extend(xVal) # add its definition to the new sequence
+
+def expandLet(x, newSeq, env):
+    env.append((x.x, x.val)) # add x's definition
+    newXs = expand(env,x.exp) # recurse into the expression
+    newSeq.extend(newXs) # add result to new sequence
+    env.pop() # remove x's definition
+
+def expandNT(x, newSeq, env):
+    newSeq.append(x) # just add the symbol
+
+expandTable = Dispatch({'Var': expandVar, 'Let': expandLet, 'NT': expandNT})
+
 def lookupLast(env, v):
     n = len(env)
     i = n-1
@@ -166,30 +195,40 @@ def lookupLast(env, v):
 def toPairs(seq):
     newSeq = []
     for x in seq:
-        if (x.__class__.__name__ == 'Var'):
-            raise Exception('No definition for variable '+x.name)
-        elif (x.__class__.__name__ == 'Let'):
-            newSeq = newSeq + expand([],x)
-        elif (x.__class__.__name__ == 'NT'):
-            newSeq.append(x.val)
-        else:
-            raise Exception("Unrecognized symbol: " + str(x)+"Type: "+type(x).__class__.__name__)
+        toPairsTable[x.__class__](x, newSeq)
     return newSeq
 
+def toPairsVar(x, newSeq):
+    raise Exception('No definition for variable '+x.name)
+
+def toPairsLet(x, newSeq):
+    newSeq.extend(expand([],x))
+
+def toPairsNT(x, newSeq):
+    newSeq.append(x.val)
+
+toPairsTable = Dispatch({'Var': toPairsVar, 'Let': toPairsLet, 'NT': toPairsNT})
+
 # tMap transforms the data values in a term (operates on NT and Let).
 # The original value is unaffected; a copy is made before any changes.
 def tMap(f, seq0):
     seq = deepcopy(seq0)
     for x in seq:
-        if (x.__class__.__name__ == 'Let'):
-            x.val = tMap(f,x.val)
-            x.exp = tMap(f,x.exp)
-        elif (x.__class__.__name__ == 'NT'):
-            x.val = f(x.val)
-        elif (x.__class__.__name__ != 'Var'):
-            raise Exception("Unrecognized symbol: " + str(x)+"Type: "+type(x).__class__.__name__)
+        tMapTable[x.__class__](x, f)
     return seq
 
+def tMapLet(x, f):
+    x.val = tMap(f,x.val)
+    x.exp = tMap(f,x.exp)
+
+def tMapNT(x, f):
+    x.val = f(x.val)
+
+def tMapVar(x, f):
+    pass
+
+tMapTable = Dispatch({'Let': tMapLet, 'NT': tMapNT, 'Var': tMapVar})
+
 # normalize fixes the probability distribution for a rule set.
 # The original value is unaffected; a copy is made before any changes.
 def normalize(prules0):
@@ -20,7 +20,7 @@
 # also an optional params field that is not used by the MIDI export backend.
 # ===============================================================================
 
-from copy import deepcopy
+from copy import copy, deepcopy
 import midi  # This is the python-midi library
 from GMInstruments import *  # Bring in a bunch of GM instrument names
 
@@ -217,36 +217,291 @@ def gmName(patch):
         return gmNames[patch[0]]
 
 
+# =================================================================
+# TRAVERSAL DISPATCH
+# Each traversal of a music structure has one handler per
+# constructor, kept in a Dispatch table. Looking up a node's handler
+# is a single dict access on its class, rather than a chain of
+# comparisons on x.__class__.__name__ at every node.
+#
+# Traversals recurse through their tables, which is the fastest way
+# through an ordinary tree, but only down to maxDepth levels. Anything
+# deeper is finished by walk, which keeps its own stack of work rather
+# than recursing, so a tree can be as deep as memory allows. The
+# handlers that walk uses have Deep in their names. They are the
+# reference for what each traversal does: the recursive handlers only
+# do the same work faster. Rules about a single node (how a Tempo
+# scales a duration, where cut stops in a Seq, and so on) are written
+# once, in functions that both kinds of handler call, and
+# KulittaTests.py checks that every traversal gives the same results
+# with maxDepth set to 0, so that walk does everything.
+# =================================================================
+
+class Dispatch(dict):
+    """
+    A method table for one traversal. Handlers are given by constructor
+    name, so any class called 'Seq' (for example) is treated as a Seq, just
+    as the old name comparisons did. The table itself is keyed by class and
+    is filled in the first time each class is seen. Unknown structures get
+    a handler that raises an EuterpeaException.
+    """
+    def __init__(self, handlers):
+        dict.__init__(self)
+        self.handlers = handlers
+
+    def __missing__(self, cls):
+        f = self.handlers.get(cls.__name__, unrecognized)
+        self[cls] = f
+        return f
+
+
+def unrecognized(x, *args):
+    raise EuterpeaException("Unrecognized musical structure: "+str(x))
+
+
+# How many levels a traversal recurses before handing the rest of a
+# subtree to walk. Traversals that call others part way down (as cut
+# calls dur) pass on the depth they have reached, so this stays well
+# inside Python's default recursion limit of 1000.
+maxDepth = 200
+
+
+def walk(table, x, ctx=None, state=None):
+    """
+    Runs a traversal of x with an explicit stack of work. Each item of work
+    is a triple (f, node, ctx). If f is None, the node is being reached for
+    the first time and its handler is looked up in table. Otherwise f is a
+    function that a handler scheduled to run after everything it scheduled
+    later (for example, to combine the results of a node's children).
+    Either way, it is called as f(node, ctx, state, work) and can add more
+    items to work. Items are taken from the end of work, so handlers add
+    their first child last.
+    :param table: the Dispatch table for the traversal
+    :param x: the music structure
+    :param ctx: context for x, like a time offset or tempo factor
+    :param state: whatever the whole traversal shares, like a list of results
+    :return: nothing - results are left in state
+    """
+    work = [(None, x, ctx)]
+    pop = work.pop
+    while work:
+        f, y, c = pop()
+        if f is None:
+            f = table[y.__class__]
+        f(y, c, state, work)
+
+
+# Handlers shared by traversals that only need to reach every node,
+# passing the same context down.
+
+def visitLeaf(x, ctx, state, work): pass
+
+def visitTree(x, ctx, state, work):
+    work.append((None, x.tree, ctx))
+
+def visitSeq(x, ctx, state, work):
+    work.append((None, x.right, ctx))
+    work.append((None, x.left, ctx))
+
+def visitPar(x, ctx, state, work):
+    work.append((None, x.bot, ctx))
+    work.append((None, x.top, ctx))
+
+
 # =================================================================
 # OPERATIONS ON MUSICAL STRUCTURES
 # Haskell Euterpea provides a number of basic operations on the
 # Music type. Only a few of them are presented here.
 # =================================================================
 
-def dur(x):
+def dur(x, durs=None):
     """
     Computes the duration of a music tree. Values are relative to the overall
     bpm for the entire tree, such that 0.25 is a quarter note.
     :param x: the music structure
+    :param durs: optional cache of durations from newDurCache. Every subtree's
+    duration is stored there, so asking again for the duration of x or any
+    part of it is a lookup rather than another traversal.
     :return: the duration of x in whole notes (wn = 1.0)
     """
-    if (x.__class__.__name__ == 'Music'):
-        d = dur(x.tree)
-        return d * (120/x.tempo)
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
+    return durAt(x, durs, 0)
+
+# depth is how far down x is in the traversal so far (see maxDepth).
+
+def durAt(x, durs, depth):
+    f = durTable[x.__class__]
+    if f is durLeaf: # leaves are not worth caching
         return x.dur
-    elif (x.__class__.__name__ == 'Seq'):
-        return (dur(x.left) + dur(x.right))
-    elif (x.__class__.__name__ == 'Par'):
-        return max(dur(x.top), dur(x.bot))
-    elif (x.__class__.__name__ == 'Modify'):
-        if (x.mod.__class__.__name__ == 'Tempo'):
-            d = dur(x.tree)
-            return d / x.mod.value
-        else:
-            return dur(x.tree)
+    elif depth > maxDepth:
+        return durDeep(x, durs)
+    elif durs is None:
+        return f(x, durs, depth + 1)
+    entry = durs.get(id(x))
+    if entry is not None and entry[0] is x:
+        return entry[1]
+    d = f(x, durs, depth + 1)
+    durs[id(x)] = (x, d)
+    return d
+
+def treeDur(x, d):
+    """
+    The duration of a Music or Modify node whose tree lasts d.
+    """
+    if (x.__class__.__name__ == 'Music'):
+        return d / (120/x.bpm)
+    elif (x.mod.__class__.__name__ == 'Tempo'):
+        return d / x.mod.value
+    return d
+
+def durTree(x, durs, depth): return treeDur(x, durAt(x.tree, durs, depth))
+def durLeaf(x, durs, depth): return x.dur
+def durSeq(x, durs, depth): return durAt(x.left, durs, depth) + durAt(x.right, durs, depth)
+def durPar(x, durs, depth): return max(durAt(x.top, durs, depth), durAt(x.bot, durs, depth))
+
+durTable = Dispatch({'Music': durTree, 'Note': durLeaf, 'Rest': durLeaf,
+                     'Seq': durSeq, 'Par': durPar, 'Modify': durTree})
+
+# The same with walk, for subtrees past maxDepth. The durations of
+# subtrees are passed up on the list state[0]: the ...Done function for
+# a node takes its children's durations off the end and puts its own
+# back.
+
+def durDeep(x, durs):
+    if durs is not None:
+        entry = durs.get(id(x))
+        if entry is not None and entry[0] is x:
+            return entry[1]
+    vals = []
+    walk(durDeepTable, x, None, (vals, durs))
+    return vals[0]
+
+def durDeepCached(x, state):
+    durs = state[1]
+    if durs is not None:
+        entry = durs.get(id(x))
+        if entry is not None and entry[0] is x:
+            state[0].append(entry[1])
+            return True
+    return False
+
+def durDeepDone(x, d, state):
+    state[0].append(d)
+    if state[1] is not None:
+        state[1][id(x)] = (x, d)
+
+def durDeepLeaf(x, ctx, state, work): state[0].append(x.dur)
+
+def durDeepTree(x, ctx, state, work):
+    if not durDeepCached(x, state):
+        work.append((durDeepTreeDone, x, ctx))
+        work.append((None, x.tree, ctx))
+
+# Seq and Par are by far the most common, so the calls are written out.
+
+def durDeepSeq(x, ctx, state, work):
+    if state[1] is None or not durDeepCached(x, state):
+        work.append((durDeepSeqDone, x, ctx))
+        work.append((None, x.right, ctx))
+        work.append((None, x.left, ctx))
+
+def durDeepPar(x, ctx, state, work):
+    if state[1] is None or not durDeepCached(x, state):
+        work.append((durDeepParDone, x, ctx))
+        work.append((None, x.bot, ctx))
+        work.append((None, x.top, ctx))
+
+def durDeepTreeDone(x, ctx, state, work):
+    durDeepDone(x, treeDur(x, state[0].pop()), state)
+
+def durDeepSeqDone(x, ctx, state, work):
+    vals, durs = state
+    d = vals.pop()
+    d = vals.pop() + d
+    vals.append(d)
+    if durs is not None:
+        durs[id(x)] = (x, d)
+
+def durDeepParDone(x, ctx, state, work):
+    vals, durs = state
+    d = vals.pop()
+    d = max(vals.pop(), d)
+    vals.append(d)
+    if durs is not None:
+        durs[id(x)] = (x, d)
+
+durDeepTable = Dispatch({'Music': durDeepTree, 'Note': durDeepLeaf, 'Rest': durDeepLeaf,
+                         'Seq': durDeepSeq, 'Par': durDeepPar, 'Modify': durDeepTree})
+
+
+def newDurCache():
+    """
+    Creates an empty duration cache for dur. The cache maps id(node) to
+    (node, duration); keeping the node makes sure that an id reused by a
+    new object after the old one is garbage collected is not mistaken for
+    a hit. A cached duration is only valid until that part of the tree is
+    changed. Functions that change durations as they go (like cut and
+    remove) call dropDur for each node they may alter, and don't use a
+    cache at all on trees with shared parts (see hasSharing).
+    :return: an empty cache
+    """
+    return dict()
+
+
+def dropDur(durs, x):
+    """
+    Forgets the cached duration of x after x has been altered. Does nothing
+    if durs is None.
+    """
+    if durs is not None:
+        durs.pop(id(x), None)
+
+
+def hasSharing(x):
+    """
+    Checks whether any part of x (leaves included) can be reached by more
+    than one path, as in line([n, n]). Changing such a part also changes
+    the durations of ancestors that a traversal never reaches.
+    :param x: the music structure
+    :return: True if some node of x is shared
+    """
+    return sharingAt(x, set(), 0)
+
+# seen holds the ids of the nodes reached so far.
+
+def sharingAt(x, seen, depth):
+    if depth > maxDepth:
+        state = [seen, False]
+        walk(sharingDeepTable, x, None, state)
+        return state[1]
+    elif id(x) in seen:
+        return True
+    seen.add(id(x))
+    return sharingTable[x.__class__](x, seen, depth + 1)
+
+def sharingLeaf(x, seen, depth): return False
+def sharingTree(x, seen, depth): return sharingAt(x.tree, seen, depth)
+def sharingSeq(x, seen, depth): return sharingAt(x.left, seen, depth) or sharingAt(x.right, seen, depth)
+def sharingPar(x, seen, depth): return sharingAt(x.top, seen, depth) or sharingAt(x.bot, seen, depth)
+
+sharingTable = Dispatch({'Music': sharingTree, 'Note': sharingLeaf, 'Rest': sharingLeaf,
+                         'Seq': sharingSeq, 'Par': sharingPar, 'Modify': sharingTree})
+
+# With walk, state is [seen, whether a node came up twice].
+
+def sharingDeepVisit(x, ctx, state, work):
+    if state[1]: # already found, so the rest doesn't matter
+        return
+    if id(x) in state[0]:
+        state[1] = True
     else:
-        raise EuterpeaException("Unrecognized musical structure: "+str(x))
+        state[0].add(id(x))
+        visitTable[x.__class__](x, ctx, state, work)
+
+visitTable = Dispatch({'Music': visitTree, 'Note': visitLeaf, 'Rest': visitLeaf,
+                       'Seq': visitSeq, 'Par': visitPar, 'Modify': visitTree})
+
+sharingDeepTable = Dispatch({'Music': sharingDeepVisit, 'Note': sharingDeepVisit, 'Rest': sharingDeepVisit,
+                             'Seq': sharingDeepVisit, 'Par': sharingDeepVisit, 'Modify': sharingDeepVisit})
 
 
 def line(musicVals):
@@ -278,6 +533,44 @@ def chord(musicVals):
     return tree
 
 
+def balancedLine(musicVals):
+    """
+    The same music as line, but the Seq constructors form a balanced tree
+    rather than a chain, so it is only about log2(n) levels deep for n
+    values. Events come out in the same order and at the same times (up
+    to rounding when adding up onsets). Values are NOT copied.
+    :param musicVals: a list of musical structures
+    :return: the sequential composition of the input list
+    """
+    return balancedTree(Seq, musicVals)
+
+
+def balancedChord(musicVals):
+    """
+    The same music as chord, built as a balanced tree of Par constructors
+    (see balancedLine). Values are NOT copied.
+    :param musicVals: a list of music structures
+    :return: the parallel composition of the input
+    """
+    return balancedTree(Par, musicVals)
+
+
+def balancedTree(cons, musicVals):
+    """
+    Joins neighbouring values with cons, level by level, until one is left.
+    :param cons: Seq or Par
+    :param musicVals: a list of music structures
+    :return: the combined structure, or None for an empty list
+    """
+    vals = list(musicVals)
+    if len(vals) == 0: return None
+    while len(vals) > 1:
+        joined = [cons(vals[i], vals[i+1]) for i in range(0, len(vals)-1, 2)]
+        if len(vals) % 2 == 1: joined.append(vals[-1])
+        vals = joined
+    return vals[0]
+
+
 def mMap(f, x):
     """
     The mMap function maps a function over the Notes in a Music value.
@@ -285,27 +578,42 @@ def mMap(f, x):
     :param x: the music structure to operate on
     :return: an in-place modification of the music structure
     """
-    if (x.__class__.__name__ == 'Music'):
-        mMap(f, x.tree)
-        return x
-    elif (x.__class__.__name__ == 'Note'):
-        f(x)
-        return x
-    elif (x.__class__.__name__ == 'Rest'):
-        return x
-    elif (x.__class__.__name__ == 'Seq'):
-        mMap(f, x.left)
-        mMap(f, x.right)
-        return x
-    elif (x.__class__.__name__ == 'Par'):
-        mMap(f, x.top)
-        mMap(f, x.bot)
-        return x
-    elif (x.__class__.__name__ == 'Modify'):
-        mMap(f, x.tree)
-        return x
-    else:
-        raise EuterpeaException("Unrecognized musical structure: "+str(x))
+    mMapTable[x.__class__](f, x, 0)
+    return x
+
+# The handlers recurse through the table directly rather than through
+# mMap, which saves a function call per node. Other traversals below
+# do the same wherever the public function has nothing else to do.
+# Here depth is how far down x itself is, and the handlers for nodes
+# with children leave anything past maxDepth to walk.
+
+def mMapNote(f, x, depth): f(x)
+def mMapRest(f, x, depth): pass
+
+def mMapTree(f, x, depth):
+    if depth > maxDepth: return walk(mMapDeepTable, x, f)
+    t = x.tree
+    mMapTable[t.__class__](f, t, depth + 1)
+
+def mMapSeq(f, x, depth):
+    if depth > maxDepth: return walk(mMapDeepTable, x, f)
+    l, r = x.left, x.right
+    mMapTable[l.__class__](f, l, depth + 1)
+    mMapTable[r.__class__](f, r, depth + 1)
+
+def mMapPar(f, x, depth):
+    if depth > maxDepth: return walk(mMapDeepTable, x, f)
+    t, b = x.top, x.bot
+    mMapTable[t.__class__](f, t, depth + 1)
+    mMapTable[b.__class__](f, b, depth + 1)
+
+mMapTable = Dispatch({'Music': mMapTree, 'Note': mMapNote, 'Rest': mMapRest,
+                      'Seq': mMapSeq, 'Par': mMapPar, 'Modify': mMapTree})
+
+def mMapDeepNote(x, f, state, work): f(x)
+
+mMapDeepTable = Dispatch({'Music': visitTree, 'Note': mMapDeepNote, 'Rest': visitLeaf,
+                          'Seq': visitSeq, 'Par': visitPar, 'Modify': visitTree})
 
 
 
@@ -319,25 +627,31 @@ def mMapAll(f, x):
     :param x: the music structure to traverse
     :return: an in-place altered version of the music structure
     """
-    if (x.__class__.__name__ == 'Music'):
-        mMapAll(f, x.tree)
-        return x
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
-        f(x)
-        return x
-    elif (x.__class__.__name__ == 'Seq'):
-        mMapAll(f, x.left)
-        mMapAll(f, x.right)
-        return x
-    elif (x.__class__.__name__ == 'Par'):
-        mMapAll(f, x.top)
-        mMapAll(f, x.bot)
-        return x
-    elif (x.__class__.__name__ == 'Modify'):
-        mMapAll(f, x.tree)
-        return x
-    else:
-        raise EuterpeaException("Unrecognized musical structure: "+str(x))
+    mMapAllTable[x.__class__](f, x, 0)
+    return x
+
+def mMapAllTree(f, x, depth):
+    if depth > maxDepth: return walk(mMapAllDeepTable, x, f)
+    t = x.tree
+    mMapAllTable[t.__class__](f, t, depth + 1)
+
+def mMapAllSeq(f, x, depth):
+    if depth > maxDepth: return walk(mMapAllDeepTable, x, f)
+    l, r = x.left, x.right
+    mMapAllTable[l.__class__](f, l, depth + 1)
+    mMapAllTable[r.__class__](f, r, depth + 1)
+
+def mMapAllPar(f, x, depth):
+    if depth > maxDepth: return walk(mMapAllDeepTable, x, f)
+    t, b = x.top, x.bot
+    mMapAllTable[t.__class__](f, t, depth + 1)
+    mMapAllTable[b.__class__](f, b, depth + 1)
+
+mMapAllTable = Dispatch({'Music': mMapAllTree, 'Note': mMapNote, 'Rest': mMapNote,
+                         'Seq': mMapAllSeq, 'Par': mMapAllPar, 'Modify': mMapAllTree})
+
+mMapAllDeepTable = Dispatch({'Music': visitTree, 'Note': mMapDeepNote, 'Rest': mMapDeepNote,
+                             'Seq': visitSeq, 'Par': visitPar, 'Modify': visitTree})
 
 
 def transpose(x, amount):
@@ -412,39 +726,73 @@ def forceMidiCompatible(x):
     return ret
 
 
-def reverse(x):
+def reverse(x, durs=None):
     """
     Reverse a musical structure in place (last note is first, etc.)
+    Reversal never changes the duration of a subtree, so one duration
+    cache is shared by the whole traversal.
     :param x: the music structure to reverse.
+    :param durs: duration cache (see newDurCache); one is made if not given
     :return: the reversal of the input.
     """
-    if (x.__class__.__name__ == 'Music'):
-        reverse(x.tree)
-        return x
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
-        return x # nothing to do
-    elif (x.__class__.__name__ == 'Seq'):
-        temp = x.left
-        x.left = x.right
-        x.right = temp
-        reverse(x.left)
-        reverse(x.right)
-        return x
-    elif (x.__class__.__name__ == 'Par'):
-        reverse(x.top)
-        reverse(x.bot)
-        dTop = dur(x.top)
-        dBot = dur(x.bot)
-        # reversal affects relative start time of each section. Must add rests to correct.
-        if dTop < dBot:
-            x.top = Seq(Rest(dBot-dTop), x.top)
-        elif dBot < dTop:
-            x.bot = Seq(Rest(dTop-dBot), x.bot)
-        return x
-    elif (x.__class__.__name__ == 'Modify'):
-        reverse(x.tree)
-        return x
-    else: raise EuterpeaException("Unrecognized musical structure: "+str(x))
+    if durs is None: durs = newDurCache()
+    reverseTable[x.__class__](x, durs, 0)
+    return x
+
+# Reversal never changes durations, so padding the shorter side of a Par
+# can be done before or after its children are reversed. Padding that
+# walk adds before reversing the children is not reversed itself.
+
+def swapSeq(x):
+    temp = x.left
+    x.left = x.right
+    x.right = temp
+
+def padPar(x, durs, depth):
+    dTop = durAt(x.top, durs, depth)
+    dBot = durAt(x.bot, durs, depth)
+    # reversal affects relative start time of each section. Must add rests to correct.
+    if dTop < dBot:
+        x.top = Seq(Rest(dBot-dTop), x.top)
+    elif dBot < dTop:
+        x.bot = Seq(Rest(dTop-dBot), x.bot)
+
+def reverseLeaf(x, durs, depth): pass # nothing to do
+
+def reverseTree(x, durs, depth):
+    if depth > maxDepth: return walk(reverseDeepTable, x, None, durs)
+    t = x.tree
+    reverseTable[t.__class__](t, durs, depth + 1)
+
+def reverseSeq(x, durs, depth):
+    if depth > maxDepth: return walk(reverseDeepTable, x, None, durs)
+    swapSeq(x)
+    l, r = x.left, x.right
+    reverseTable[l.__class__](l, durs, depth + 1)
+    reverseTable[r.__class__](r, durs, depth + 1)
+
+def reversePar(x, durs, depth):
+    if depth > maxDepth: return walk(reverseDeepTable, x, None, durs)
+    t, b = x.top, x.bot
+    reverseTable[t.__class__](t, durs, depth + 1)
+    reverseTable[b.__class__](b, durs, depth + 1)
+    padPar(x, durs, depth + 1)
+
+reverseTable = Dispatch({'Music': reverseTree, 'Note': reverseLeaf, 'Rest': reverseLeaf,
+                         'Seq': reverseSeq, 'Par': reversePar, 'Modify': reverseTree})
+
+def reverseDeepSeq(x, ctx, durs, work):
+    swapSeq(x)
+    work.append((None, x.right, ctx))
+    work.append((None, x.left, ctx))
+
+def reverseDeepPar(x, ctx, durs, work):
+    work.append((None, x.bot, ctx))
+    work.append((None, x.top, ctx))
+    padPar(x, durs, 0)
+
+reverseDeepTable = Dispatch({'Music': visitTree, 'Note': visitLeaf, 'Rest': visitLeaf,
+                             'Seq': reverseDeepSeq, 'Par': reverseDeepPar, 'Modify': visitTree})
 
 
 def times(music, n):
@@ -456,13 +804,14 @@ def times(music, n):
     :param n: how many times to repeat?
     :return: a new structure (so this should be called as a = times(b,n)
     """
-    if n <= 0: return Rest(0)
-    else:
-        m = deepcopy(music)
-        return Seq(m, times(music, n-1))
+    ms = [copyMusic(music) for i in range(n)]
+    tree = Rest(0)
+    for m in reversed(ms): # built from the end, as Seq(m, times(music, n-1))
+        tree = Seq(m, tree)
+    return tree
 
 
-def cut(x, amount):
+def cut(x, amount, durs=None):
     """
     Keeps only the first duration amount of a musical structure. The amount
     is in measures at the reference duration, which is 120bpm unless specified
@@ -470,74 +819,168 @@ def cut(x, amount):
     a lot of meaningless structure in place, with leaves occupied by Rest(0).
     :param x: the music value to alter
     :param amount: how many whole notes worth to take.
+    :param durs: duration cache (see newDurCache); one is made if not given
     :return: the furst amount of the music structure by time (whole note = 1.0)
     """
-    if (x.__class__.__name__ == 'Music'):
-        cut(x.tree, amount)
-        return x
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
-        if amount <= x.dur:
-            x.dur = amount
-        return x
-    elif (x.__class__.__name__ == 'Seq'):
-        dLeft = dur(x.left)
-        if dLeft >= amount: # do we have enough duration on the left?
-            cut(x.left, amount)
-            x.right = Rest(0) # right side becomes nonexistent
-        elif dLeft+dur(x.right) >= amount: # do we have enough duration on the right?
-            cut(x.right, amount-dLeft)
-        return x
-    elif (x.__class__.__name__ == 'Par'):
-        cut(x.top, amount)
-        cut(x.bot, amount)
-        return x
-    elif (x.__class__.__name__ == 'Modify'):
-        if (x.mod.__class__.__name__ == 'Tempo'):
-            cut(x.tree, amount*x.mod.value)
-        else:
-            cut(x.tree, amount)
-        return x
-    else: raise EuterpeaException("Unrecognized musical structure: " + str(x))
+    cutAt(x, amount, alterCache(x, durs), 0)
+    return x
+
+# A node's cached duration is dropped as soon as the node is reached.
+# Its parent has already read it, and nothing reads it again before
+# the node's part of the tree is done. That only holds if nothing in
+# the tree is shared: otherwise a part altered through one parent can
+# make an ancestor on another path out of date, so no cache is used.
+
+def alterCache(x, durs):
+    if hasSharing(x):
+        if durs is not None: durs.clear() # entries for ancestors may go stale
+        return None
+    if durs is None: durs = newDurCache()
+    return durs
+
+def cutAt(x, amount, durs, depth):
+    if depth > maxDepth:
+        walk(cutDeepTable, x, amount, durs)
+    else:
+        dropDur(durs, x)
+        cutTable[x.__class__](x, amount, durs, depth + 1)
+
+# The amount that applies inside a Music or Modify node
+
+def treeAmount(x, amount):
+    if (x.__class__.__name__ == 'Modify' and x.mod.__class__.__name__ == 'Tempo'):
+        return amount*x.mod.value
+    return amount
+
+# Which side of a Seq cut goes on with, and the amount for it, or None
+# if the Seq is short enough to keep whole.
+
+def cutSeqPart(x, amount, durs, depth):
+    dLeft = durAt(x.left, durs, depth)
+    if dLeft >= amount: # do we have enough duration on the left?
+        x.right = Rest(0) # right side becomes nonexistent
+        return (x.left, amount)
+    elif dLeft+durAt(x.right, durs, depth) >= amount: # do we have enough duration on the right?
+        return (x.right, amount-dLeft)
+    return None
+
+def cutTree(x, amount, durs, depth): cutAt(x.tree, treeAmount(x, amount), durs, depth)
+
+# Leaves have nothing to do with depth or work, so walk uses this too.
+def cutLeaf(x, amount, durs, depth):
+    if amount <= x.dur:
+        x.dur = amount
+
+def cutSeq(x, amount, durs, depth):
+    part = cutSeqPart(x, amount, durs, depth)
+    if part is not None:
+        cutAt(part[0], part[1], durs, depth)
+
+def cutPar(x, amount, durs, depth):
+    cutAt(x.top, amount, durs, depth)
+    cutAt(x.bot, amount, durs, depth)
+
+cutTable = Dispatch({'Music': cutTree, 'Note': cutLeaf, 'Rest': cutLeaf,
+                     'Seq': cutSeq, 'Par': cutPar, 'Modify': cutTree})
+
+# The same with walk, for subtrees past maxDepth.
+
+def cutDeepTree(x, amount, durs, work):
+    dropDur(durs, x)
+    work.append((None, x.tree, treeAmount(x, amount)))
+
+def cutDeepSeq(x, amount, durs, work):
+    dropDur(durs, x)
+    part = cutSeqPart(x, amount, durs, 0)
+    if part is not None:
+        work.append((None, part[0], part[1]))
+
+def cutDeepPar(x, amount, durs, work):
+    dropDur(durs, x)
+    work.append((None, x.bot, amount))
+    work.append((None, x.top, amount))
+
+cutDeepTable = Dispatch({'Music': cutDeepTree, 'Note': cutLeaf, 'Rest': cutLeaf,
+                         'Seq': cutDeepSeq, 'Par': cutDeepPar, 'Modify': cutDeepTree})
 
 
-def remove(x, amount):
+def remove(x, amount, durs=None):
     """
     The opposite of "cut," chopping away the first amount. Note that this
     operation is messy - it can leave a lot of meaningless structure in
     place, with leaves occupied by Rest(0).
     :param x: the music structure to alter
     :param amount: how much to cut off of the beginning?
+    :param durs: duration cache (see newDurCache); one is made if not given
     :return:
     """
-    if amount<=0: pass # nothing to remove!
-    elif (x.__class__.__name__ == 'Music'):
-        remove(x.tree, amount)
-        return x
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
-        if amount >= x.dur:
-            x.dur = 0
-        if amount < x.dur:
-            x.dur = x.dur - amount
-        return x
-    elif (x.__class__.__name__ == 'Seq'):
-        dLeft = dur(x.left)
-        if dLeft >= amount:
-            remove(x.left, amount)
-        elif dLeft + dur(x.right) >= amount:
-            x.left = Rest(0) # remove all of the left side
-            remove(x.right, amount-dLeft)
-        return x
-    elif (x.__class__.__name__ == 'Par'):
-        remove(x.top, amount)
-        remove(x.bot, amount)
-        return x
-    elif (x.__class__.__name__ == 'Modify'):
-        if (x.mod.__class__.__name__ == 'Tempo'):
-            remove(x.tree, amount*x.mod.value)
-        else:
-            remove(x.tree, amount)
-        return x
-    else: raise EuterpeaException("Unrecognized musical structure: " + str(x))
+    if amount<=0: return # nothing to remove!
+    removeAt(x, amount, alterCache(x, durs), 0)
+    return x
+
+# As for cut, cached durations are dropped when a node is reached (and
+# none are used if anything is shared). Only a Tempo can bring the
+# amount down to nothing, so that is the only place that has to check.
+
+def removeAt(x, amount, durs, depth):
+    if depth > maxDepth:
+        walk(removeDeepTable, x, amount, durs)
+    else:
+        dropDur(durs, x)
+        removeTable[x.__class__](x, amount, durs, depth + 1)
+
+# Which side of a Seq remove goes on with, and the amount for it, as
+# for cutSeqPart.
+
+def removeSeqPart(x, amount, durs, depth):
+    dLeft = durAt(x.left, durs, depth)
+    if dLeft >= amount:
+        return (x.left, amount)
+    elif dLeft + durAt(x.right, durs, depth) >= amount:
+        x.left = Rest(0) # remove all of the left side
+        return (x.right, amount-dLeft)
+    return None
+
+def removeTree(x, amount, durs, depth):
+    amount = treeAmount(x, amount)
+    if amount > 0:
+        removeAt(x.tree, amount, durs, depth)
+
+# Used by walk too, as for cutLeaf.
+def removeLeaf(x, amount, durs, depth):
+    if amount >= x.dur:
+        x.dur = 0
+    if amount < x.dur:
+        x.dur = x.dur - amount
+
+def removeSeq(x, amount, durs, depth):
+    part = removeSeqPart(x, amount, durs, depth)
+    if part is not None:
+        removeAt(part[0], part[1], durs, depth)
+
+def removePar(x, amount, durs, depth):
+    removeAt(x.top, amount, durs, depth)
+    removeAt(x.bot, amount, durs, depth)
+
+removeTable = Dispatch({'Music': removeTree, 'Note': removeLeaf, 'Rest': removeLeaf,
+                        'Seq': removeSeq, 'Par': removePar, 'Modify': removeTree})
+
+# The same with walk, for subtrees past maxDepth.
+
+def removeDeepTree(x, amount, durs, work):
+    dropDur(durs, x)
+    amount = treeAmount(x, amount)
+    if amount > 0:
+        work.append((None, x.tree, amount))
+
+def removeDeepSeq(x, amount, durs, work):
+    dropDur(durs, x)
+    part = removeSeqPart(x, amount, durs, 0)
+    if part is not None:
+        work.append((None, part[0], part[1]))
+
+removeDeepTable = Dispatch({'Music': removeDeepTree, 'Note': removeLeaf, 'Rest': removeLeaf,
+                            'Seq': removeDeepSeq, 'Par': cutDeepPar, 'Modify': removeDeepTree})
 
 
 def mFold(x, noteOp, restOp, seqOp, parOp, modOp):
@@ -555,64 +998,125 @@ def mFold(x, noteOp, restOp, seqOp, parOp, modOp):
     :param modOp:
     :return:
     """
-    if (x.__class__.__name__ == 'Music'):
-        return mFold(x.tree, noteOp, restOp, seqOp, parOp, modOp)
-    elif (x.__class__.__name__ == 'Note'):
-        return noteOp(x)
-    elif (x.__class__.__name__ == 'Rest'):
-        return restOp(x)
-    elif (x.__class__.__name__ == 'Seq'):
-        leftVal = mFold(x.left, noteOp, restOp, seqOp, parOp, modOp)
-        rightVal = mFold(x.right, noteOp, restOp, seqOp, parOp, modOp)
-        return seqOp(leftVal, rightVal)
-    elif (x.__class__.__name__ == 'Par'):
-        topVal = mFold(x.top, noteOp, restOp, seqOp, parOp, modOp)
-        botVal = mFold(x.bot, noteOp, restOp, seqOp, parOp, modOp)
-        return parOp(topVal, botVal)
-    elif (x.__class__.__name__ == 'Modify'):
-        val = mFold(x.tree, noteOp, restOp, seqOp, parOp, modOp)
-        return modOp(x.mod, val)
-    else: raise EuterpeaException("Unrecognized musical structure: " + str(x))
+    return mFoldTable[x.__class__](x, noteOp, restOp, seqOp, parOp, modOp, 0)
+
+def mFoldMusic(x, noteOp, restOp, seqOp, parOp, modOp, depth):
+    if depth > maxDepth: return mFoldDeep(x, noteOp, restOp, seqOp, parOp, modOp)
+    t = x.tree
+    return mFoldTable[t.__class__](t, noteOp, restOp, seqOp, parOp, modOp, depth + 1)
+
+def mFoldNote(x, noteOp, restOp, seqOp, parOp, modOp, depth):
+    return noteOp(x)
+
+def mFoldRest(x, noteOp, restOp, seqOp, parOp, modOp, depth):
+    return restOp(x)
+
+def mFoldSeq(x, noteOp, restOp, seqOp, parOp, modOp, depth):
+    if depth > maxDepth: return mFoldDeep(x, noteOp, restOp, seqOp, parOp, modOp)
+    l, r = x.left, x.right
+    leftVal = mFoldTable[l.__class__](l, noteOp, restOp, seqOp, parOp, modOp, depth + 1)
+    rightVal = mFoldTable[r.__class__](r, noteOp, restOp, seqOp, parOp, modOp, depth + 1)
+    return seqOp(leftVal, rightVal)
+
+def mFoldPar(x, noteOp, restOp, seqOp, parOp, modOp, depth):
+    if depth > maxDepth: return mFoldDeep(x, noteOp, restOp, seqOp, parOp, modOp)
+    t, b = x.top, x.bot
+    topVal = mFoldTable[t.__class__](t, noteOp, restOp, seqOp, parOp, modOp, depth + 1)
+    botVal = mFoldTable[b.__class__](b, noteOp, restOp, seqOp, parOp, modOp, depth + 1)
+    return parOp(topVal, botVal)
+
+def mFoldModify(x, noteOp, restOp, seqOp, parOp, modOp, depth):
+    if depth > maxDepth: return mFoldDeep(x, noteOp, restOp, seqOp, parOp, modOp)
+    t = x.tree
+    val = mFoldTable[t.__class__](t, noteOp, restOp, seqOp, parOp, modOp, depth + 1)
+    return modOp(x.mod, val)
+
+mFoldTable = Dispatch({'Music': mFoldMusic, 'Note': mFoldNote, 'Rest': mFoldRest,
+                       'Seq': mFoldSeq, 'Par': mFoldPar, 'Modify': mFoldModify})
+
+def mFoldDeep(x, noteOp, restOp, seqOp, parOp, modOp):
+    vals = []
+    walk(mFoldDeepTable, x, None, (vals, noteOp, restOp, seqOp, parOp, modOp))
+    return vals[0]
+
+# state is (vals, noteOp, restOp, seqOp, parOp, modOp), with the results
+# for subtrees passed up on vals as for dur.
+
+def mFoldDeepNote(x, ctx, state, work):
+    state[0].append(state[1](x))
+
+def mFoldDeepRest(x, ctx, state, work):
+    state[0].append(state[2](x))
+
+def mFoldDeepSeq(x, ctx, state, work):
+    work.append((mFoldDeepSeqDone, x, ctx))
+    work.append((None, x.right, ctx))
+    work.append((None, x.left, ctx))
+
+def mFoldDeepPar(x, ctx, state, work):
+    work.append((mFoldDeepParDone, x, ctx))
+    work.append((None, x.bot, ctx))
+    work.append((None, x.top, ctx))
+
+def mFoldDeepModify(x, ctx, state, work):
+    work.append((mFoldDeepModifyDone, x, ctx))
+    work.append((None, x.tree, ctx))
+
+def mFoldDeepSeqDone(x, ctx, state, work):
+    vals = state[0]
+    rightVal = vals.pop()
+    leftVal = vals.pop()
+    vals.append(state[3](leftVal, rightVal))
+
+def mFoldDeepParDone(x, ctx, state, work):
+    vals = state[0]
+    botVal = vals.pop()
+    topVal = vals.pop()
+    vals.append(state[4](topVal, botVal))
+
+def mFoldDeepModifyDone(x, ctx, state, work):
+    vals = state[0]
+    vals.append(state[5](x.mod, vals.pop()))
+
+mFoldDeepTable = Dispatch({'Music': visitTree, 'Note': mFoldDeepNote, 'Rest': mFoldDeepRest,
+                           'Seq': mFoldDeepSeq, 'Par': mFoldDeepPar, 'Modify': mFoldDeepModify})
 
 
 def firstPitch(x):
     """
     The firstPitch function returns the first pitch in the Music value.
     None is returned if there are no notes. Preference is lef tand top.
+    Only the way down to the first Note is visited, so a stack of work is
+    kept as in walk on trees of any depth, with no recursive version.
     :param x:
     :return:
     """
-    if (x.__class__.__name__ == 'Music'):
-        return firstPitch(x.tree)
-    elif (x.__class__.__name__ == 'Note'):
-        return x.pitchf
-    elif (x.__class__.__name__ == 'Rest'):
-        return None
-    elif (x.__class__.__name__ == 'Seq'):
-        leftVal = firstPitch(x.left)
-        if leftVal==None: return firstPitch(x.right)
-        else: return leftVal
-    elif (x.__class__.__name__ == 'Par'):
-        topVal = firstPitch(x.top)
-        if topVal==None: return firstPitch(x.bot)
-        else: return topVal
-    elif (x.__class__.__name__ == 'Modify'):
-        return firstPitch(x.tree)
-    else: raise EuterpeaException("Unrecognized musical structure: " + str(x))
+    work = [(None, x, None)]
+    while work: # as walk, but stopping at the first Note
+        f, y, c = work.pop()
+        p = firstPitchTable[y.__class__](y, c, None, work)
+        if p is not None: return p
+    return None
+
+def firstPitchNote(x, ctx, state, work): return x.pitch
+
+firstPitchTable = Dispatch({'Music': visitTree, 'Note': firstPitchNote, 'Rest': visitLeaf,
+                            'Seq': visitSeq, 'Par': visitPar, 'Modify': visitTree})
 
 
 def getPitches(m):
     """
-    An application of mFold to extract all pitches in the music
-    structure as a list.
+    Extract all pitches in the music structure as a list, in the same
+    order as mFold visits the Notes. The pitches are appended to one list
+    by mMap rather than joining lists with mFold, which would copy them
+    over and over on a long line.
     :param m:
     :return:
     """
-    def fn(n): return [n.pitch]
-    def fr(r): return []
-    def fcat(a,b): return a+b
-    def fm(m,t): return t
-    return mFold(m, fn, fr, fcat, fcat, fm)
+    ps = []
+    def f(n): ps.append(n.pitch)
+    mMap(f, m)
+    return ps
 
 
 def invertAt(m, pitchRef):
@@ -655,33 +1159,60 @@ def removeInstruments(x):
     :param x:
     :return:
     """
-    def checkInstMod(x): # function to get rid of individual nodes
-        if x.__class__.__name__ == 'Modify':
-            if x.mod.__class__.__name__ == 'Instrument': return x.tree
-            else: return x
+    return removeInstrumentsAt(x, 0)
+
+def removeInstrumentsAt(x, depth):
+    if depth > maxDepth:
+        walk(removeInstrumentsDeepTable, x)
+        return checkInstMod(x)
+    return removeInstrumentsTable[x.__class__](x, depth + 1)
+
+def checkInstMod(x): # function to get rid of individual nodes
+    if x.__class__.__name__ == 'Modify':
+        if x.mod.__class__.__name__ == 'Instrument': return x.tree
         else: return x
-    if x.__class__.__name__ == 'Music':
-        tNew = checkInstMod(x.tree)
-        removeInstruments(x.tree)
-        return x
-    elif x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest':
-        return x
-    elif x.__class__.__name__ == 'Seq':
-        x.left = checkInstMod(x.left)
-        x.right = checkInstMod(x.right)
-        removeInstruments(x.left)
-        removeInstruments(x.right)
-        return x
-    elif x.__class__.__name__ == 'Par':
-        x.top = checkInstMod(x.top)
-        x.bot = checkInstMod(x.bot)
-        removeInstruments(x.top)
-        removeInstruments(x.bot)
-        return x
-    elif x.__class__.__name__ == 'Modify':
-        xNew = checkInstMod(x)
-        return xNew
-    else: raise EuterpeaException("Unrecognized musical structure: " + str(x))
+    else: return x
+
+def removeInstrumentsMusic(x, depth):
+    removeInstrumentsAt(x.tree, depth)
+    return x
+
+def removeInstrumentsLeaf(x, depth): return x
+def removeInstrumentsModify(x, depth): return checkInstMod(x)
+
+def removeInstrumentsSeq(x, depth):
+    x.left = checkInstMod(x.left)
+    x.right = checkInstMod(x.right)
+    removeInstrumentsAt(x.left, depth)
+    removeInstrumentsAt(x.right, depth)
+    return x
+
+def removeInstrumentsPar(x, depth):
+    x.top = checkInstMod(x.top)
+    x.bot = checkInstMod(x.bot)
+    removeInstrumentsAt(x.top, depth)
+    removeInstrumentsAt(x.bot, depth)
+    return x
+
+removeInstrumentsTable = Dispatch({'Music': removeInstrumentsMusic, 'Note': removeInstrumentsLeaf,
+                                   'Rest': removeInstrumentsLeaf, 'Seq': removeInstrumentsSeq,
+                                   'Par': removeInstrumentsPar, 'Modify': removeInstrumentsModify})
+
+def removeInstrumentsDeepSeq(x, ctx, state, work):
+    x.left = checkInstMod(x.left)
+    x.right = checkInstMod(x.right)
+    work.append((None, x.right, ctx))
+    work.append((None, x.left, ctx))
+
+def removeInstrumentsDeepPar(x, ctx, state, work):
+    x.top = checkInstMod(x.top)
+    x.bot = checkInstMod(x.bot)
+    work.append((None, x.bot, ctx))
+    work.append((None, x.top, ctx))
+
+removeInstrumentsDeepTable = Dispatch({'Music': visitTree, 'Note': visitLeaf, 'Rest': visitLeaf,
+                                       'Seq': removeInstrumentsDeepSeq, 'Par': removeInstrumentsDeepPar,
+                                       'Modify': visitLeaf})
 
 
 def changeInstrument(m, value):
@@ -713,43 +1244,266 @@ def applyTempo(x, tempo=1.0):
     :param tempo:
     :return:
     """
-    y = deepcopy(x)
+    y = copyMusic(x, False) # the only copy made, with no sharing left in it
     y = applyTempoInPlace(y, tempo)
     return y
 
 
+def copyMusic(x, keepSharing=True):
+    """
+    The same as deepcopy(x), including any sharing of values within x, but
+    without recursing down the tree, so it works on trees of any depth.
+    Only the leaves and modifiers are passed to deepcopy.
+    :param x: the music structure to copy
+    :param keepSharing: if False, a subtree reached along more than one path
+    is copied once for each path, so nothing in the copy is shared. This is
+    what the in-place functions need, like applyTempoInPlace, which would
+    otherwise change a shared subtree once per path.
+    :return: a copy of x
+    """
+    memo = dict() if keepSharing else None
+    root = []
+    walk(copyMusicTable, x, (root, 0), memo)
+    return root[0]
+
+# The context for a node is (parent copy, slot): the list or attribute
+# of the parent's copy that receives the node's copy. memo is None when
+# sharing is not kept, and then deepcopy starts a new memo for each leaf.
+
+def copyInto(ctx, y):
+    parent, slot = ctx
+    if slot == 0: parent.append(y)
+    else: setattr(parent, slot, y)
+
+def copyLeaf(x, ctx, memo, work):
+    copyInto(ctx, deepcopy(x, memo))
+
+def copyNode(x, ctx, memo, work):
+    y = None if memo is None else memo.get(id(x))
+    if y is None:
+        y = copy(x)
+        if memo is not None:
+            memo[id(x)] = y
+            memo.setdefault(id(memo), []).append(x) # keep x alive, as deepcopy does
+        if (x.__class__.__name__ == 'Seq'):
+            work.append((None, x.right, (y, 'right')))
+            work.append((None, x.left, (y, 'left')))
+        elif (x.__class__.__name__ == 'Par'):
+            work.append((None, x.bot, (y, 'bot')))
+            work.append((None, x.top, (y, 'top')))
+        else:
+            if (x.__class__.__name__ == 'Modify'):
+                y.mod = deepcopy(x.mod, memo)
+            work.append((None, x.tree, (y, 'tree')))
+    copyInto(ctx, y)
+
+copyMusicTable = Dispatch({'Music': copyNode, 'Note': copyLeaf, 'Rest': copyLeaf,
+                           'Seq': copyNode, 'Par': copyNode, 'Modify': copyNode})
+
+
 def applyTempoInPlace(x, tempo=1.0):
     """
     applyTempoInPlace performs in-place interpretation of Tempo modifiers.
     However, it still has to be used as: foo = applyTempoInPace(foo)
+    Nothing is copied: the tempo factor is carried down the tree and nested
+    Tempo modifiers multiply it (see composeTempo). A subtree that x shares
+    between several paths is scaled once for each of them, so use applyTempo
+    on such trees.
     :param x:
     :param tempo:
     :return:
     """
+    return applyTempoAt(x, tempo, 0)
+
+def applyTempoAt(x, tempo, depth):
+    if depth > maxDepth: return applyTempoDeep(x, tempo)
+    return applyTempoTable[x.__class__](x, tempo, depth + 1)
+
+# What takes the place of a Music or Modify node once its tree has been
+# done: the node itself, or just the tree in the case of a Tempo.
+
+def tempoDone(x, tree):
+    x.tree = tree
     if (x.__class__.__name__ == 'Music'):
-        x.tree = applyTempo(x.tree, 120/x.bpm)
         x.bpm = 120
-        return x
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
-        x.dur = x.dur / tempo
-        return x
-    elif (x.__class__.__name__ == 'Seq'):
-        x.left = applyTempo(x.left, tempo)
-        x.right = applyTempo(x.right, tempo)
-        return x
-    elif (x.__class__.__name__ == 'Par'):
-        x.top = applyTempo(x.top, tempo)
-        x.bot = applyTempo(x.bot, tempo)
-        return x
-    elif (x.__class__.__name__ == 'Modify'):
-        if (x.mod.__class__.__name__ == 'Tempo'):
-            x.tree = applyTempo(x.tree, x.mod.value)
-            return x.tree
-        else:
-            x.tree = applyTempo(x.tree, tempo)
-            return x
-    else:
-        raise EuterpeaException("Unrecognized musical structure: "+str(x))
+    elif (x.mod.__class__.__name__ == 'Tempo'):
+        return x.tree
+    return x
+
+def applyTempoTree(x, tempo, depth):
+    return tempoDone(x, applyTempoAt(x.tree, treeTempo(x, tempo), depth))
+
+def applyTempoLeaf(x, tempo, depth):
+    x.dur = x.dur / tempo
+    return x
+
+def applyTempoSeq(x, tempo, depth):
+    x.left = applyTempoAt(x.left, tempo, depth)
+    x.right = applyTempoAt(x.right, tempo, depth)
+    return x
+
+def applyTempoPar(x, tempo, depth):
+    x.top = applyTempoAt(x.top, tempo, depth)
+    x.bot = applyTempoAt(x.bot, tempo, depth)
+    return x
+
+applyTempoTable = Dispatch({'Music': applyTempoTree, 'Note': applyTempoLeaf, 'Rest': applyTempoLeaf,
+                            'Seq': applyTempoSeq, 'Par': applyTempoPar, 'Modify': applyTempoTree})
+
+def applyTempoDeep(x, tempo):
+    vals = []
+    walk(applyTempoDeepTable, x, tempo, vals)
+    return vals[0]
+
+# The value left on vals for each subtree is what replaces it.
+
+def applyTempoDeepLeaf(x, tempo, vals, work):
+    vals.append(applyTempoLeaf(x, tempo, 0))
+
+def applyTempoDeepTree(x, tempo, vals, work):
+    work.append((applyTempoDeepTreeDone, x, tempo))
+    work.append((None, x.tree, treeTempo(x, tempo)))
+
+def applyTempoDeepSeq(x, tempo, vals, work):
+    work.append((applyTempoDeepSeqDone, x, tempo))
+    work.append((None, x.right, tempo))
+    work.append((None, x.left, tempo))
+
+def applyTempoDeepPar(x, tempo, vals, work):
+    work.append((applyTempoDeepParDone, x, tempo))
+    work.append((None, x.bot, tempo))
+    work.append((None, x.top, tempo))
+
+def applyTempoDeepTreeDone(x, tempo, vals, work):
+    vals.append(tempoDone(x, vals.pop()))
+
+def applyTempoDeepSeqDone(x, tempo, vals, work):
+    x.right = vals.pop()
+    x.left = vals.pop()
+    vals.append(x)
+
+def applyTempoDeepParDone(x, tempo, vals, work):
+    x.bot = vals.pop()
+    x.top = vals.pop()
+    vals.append(x)
+
+applyTempoDeepTable = Dispatch({'Music': applyTempoDeepTree, 'Note': applyTempoDeepLeaf, 'Rest': applyTempoDeepLeaf,
+                                'Seq': applyTempoDeepSeq, 'Par': applyTempoDeepPar, 'Modify': applyTempoDeepTree})
+
+
+def composeTempo(outer, inner):
+    """
+    Combines an enclosing tempo factor with a nested Tempo value. Tempo
+    factors multiply, so a Tempo(2.0) inside a Tempo(3.0) is six times as
+    fast as the reference tempo.
+    """
+    return outer * inner
+
+
+def treeTempo(x, tempo):
+    """
+    The tempo factor in effect inside a Music or Modify node, where tempo
+    is the factor outside it (None if no Tempo has been reached yet).
+    """
+    if (x.__class__.__name__ == 'Music'):
+        return 120/x.bpm
+    elif (x.mod.__class__.__name__ == 'Tempo'):
+        return x.mod.value if tempo is None else composeTempo(tempo, x.mod.value)
+    return tempo
+
+
+def tempoDur(x, tempo, durs):
+    """
+    The duration x would have after applyTempoInPlace(x, tempo), without
+    changing x. A tempo of None means no tempo interpretation at all (the
+    same as dur). Results are kept in durs (see newDurCache).
+    :param x: the music structure
+    :param tempo: the tempo factor in effect for x, or None
+    :param durs: duration cache
+    :return: the scaled duration of x
+    """
+    return tempoDurAt(x, tempo, durs, 0)
+
+def tempoDurAt(x, tempo, durs, depth):
+    if tempo is None:
+        return durAt(x, durs, depth)
+    f = tempoDurTable[x.__class__]
+    if f is tempoDurLeaf:
+        return x.dur / tempo
+    elif depth > maxDepth:
+        return tempoDurDeep(x, tempo, durs)
+    key = (id(x), tempo)
+    entry = durs.get(key)
+    if entry is not None and entry[0] is x:
+        return entry[1]
+    d = f(x, tempo, durs, depth + 1)
+    durs[key] = (x, d)
+    return d
+
+def tempoDurTree(x, tempo, durs, depth): return tempoDurAt(x.tree, treeTempo(x, tempo), durs, depth)
+def tempoDurLeaf(x, tempo, durs, depth): return x.dur / tempo
+def tempoDurSeq(x, tempo, durs, depth): return tempoDurAt(x.left, tempo, durs, depth) + tempoDurAt(x.right, tempo, durs, depth)
+def tempoDurPar(x, tempo, durs, depth): return max(tempoDurAt(x.top, tempo, durs, depth), tempoDurAt(x.bot, tempo, durs, depth))
+
+tempoDurTable = Dispatch({'Music': tempoDurTree, 'Note': tempoDurLeaf, 'Rest': tempoDurLeaf,
+                          'Seq': tempoDurSeq, 'Par': tempoDurPar, 'Modify': tempoDurTree})
+
+# The same with walk, for subtrees past maxDepth. This works as durDeep
+# does, with the tempo factor as context and (id, tempo) as the key.
+
+def tempoDurDeep(x, tempo, durs):
+    entry = durs.get((id(x), tempo))
+    if entry is not None and entry[0] is x:
+        return entry[1]
+    vals = []
+    walk(tempoDurDeepTable, x, tempo, (vals, durs))
+    return vals[0]
+
+def tempoDurDeepCached(x, tempo, state):
+    entry = state[1].get((id(x), tempo))
+    if entry is not None and entry[0] is x:
+        state[0].append(entry[1])
+        return True
+    return False
+
+def tempoDurDeepDone(x, tempo, d, state):
+    state[0].append(d)
+    state[1][(id(x), tempo)] = (x, d)
+
+def tempoDurDeepLeaf(x, tempo, state, work): state[0].append(x.dur / tempo)
+
+def tempoDurDeepTree(x, tempo, state, work):
+    if not tempoDurDeepCached(x, tempo, state):
+        work.append((tempoDurDeepTreeDone, x, tempo))
+        work.append((None, x.tree, treeTempo(x, tempo)))
+
+def tempoDurDeepSeq(x, tempo, state, work):
+    if not tempoDurDeepCached(x, tempo, state):
+        work.append((tempoDurDeepSeqDone, x, tempo))
+        work.append((None, x.right, tempo))
+        work.append((None, x.left, tempo))
+
+def tempoDurDeepPar(x, tempo, state, work):
+    if not tempoDurDeepCached(x, tempo, state):
+        work.append((tempoDurDeepParDone, x, tempo))
+        work.append((None, x.bot, tempo))
+        work.append((None, x.top, tempo))
+
+def tempoDurDeepTreeDone(x, tempo, state, work):
+    tempoDurDeepDone(x, tempo, state[0].pop(), state)
+
+def tempoDurDeepSeqDone(x, tempo, state, work):
+    vals = state[0]
+    dRight = vals.pop()
+    tempoDurDeepDone(x, tempo, vals.pop() + dRight, state)
+
+def tempoDurDeepParDone(x, tempo, state, work):
+    vals = state[0]
+    dBot = vals.pop()
+    tempoDurDeepDone(x, tempo, max(vals.pop(), dBot), state)
+
+tempoDurDeepTable = Dispatch({'Music': tempoDurDeepTree, 'Note': tempoDurDeepLeaf, 'Rest': tempoDurDeepLeaf,
+                              'Seq': tempoDurDeepSeq, 'Par': tempoDurDeepPar, 'Modify': tempoDurDeepTree})
 
 
 class MEvent:
@@ -772,41 +1526,108 @@ class MEvent:
         return str(self)
 
 
-def musicToMEvents(x, currentTime=0, currentInstrument=(-1,INST)):
+def musicToMEvents(x, currentTime=0, currentInstrument=(-1,INST), durs=None):
     """
     The musicToMEvents function converts a tree of Notes and Rests into an
-    event structure.
+    event structure. The tree is walked once, appending events to a single
+    list (see addMEvents), and that list is sorted by onset once at the end.
+    The sort is stable, so events with the same onset come out in tree order
+    (left before right, top before bottom). Tempo modifiers are interpreted
+    on the fly, so nothing is copied.
     :param x:
     :param currentTime:
     :param currentInstrument:
+    :param durs: duration cache (see newDurCache); one is made if not given
     :return:
     """
+    if durs is None: durs = newDurCache()
+    evs = []
+    addMEvents(x, currentTime, currentInstrument, evs, durs)
+    evs.sort(key=lambda e: e.eTime)
+    return evs
+
+
+def addMEvents(x, currentTime, currentInstrument, evs, durs, tempo=None):
+    """
+    Appends the events of x to evs in tree order, without sorting them.
+    :param x: the music structure
+    :param currentTime: onset of x
+    :param currentInstrument: patch for the notes in x
+    :param evs: the list to add events to
+    :param durs: duration cache (see newDurCache)
+    :param tempo: the tempo factor in effect (see tempoDur), or None outside
+    of any Tempo modifier
+    :return: nothing - evs is altered in place
+    """
+    addMEventsTable[x.__class__](x, currentTime, currentInstrument, evs, durs, tempo, 0)
+
+# The event for a Note, if it has one, and the context inside a Music or
+# Modify node. A context is (currentTime, currentInstrument, tempo).
+
+def noteEvent(x, currentTime, currentInstrument, tempo, evs):
+    d = x.dur if tempo is None else x.dur / tempo
+    if d > 0: # one note = one event
+        evs.append(MEvent(currentTime, x.pitch, d, x.vol, currentInstrument))
+    # when duration is <0, there should be no event.
+
+def eventContext(x, ctx):
+    currentTime, currentInstrument, tempo = ctx
     if (x.__class__.__name__ == 'Music'):
-        y = applyTempo(x) # interpret all tempo scaling factors before continuing
-        return musicToMEvents(y.tree, 0, (-1, INST))
-    elif (x.__class__.__name__ == 'Note'):
-        if x.dur > 0:
-            return [MEvent(currentTime, x.pitch, x.dur, x.vol, currentInstrument)] # one note = one event
-        else: # when duration is <0, there should be no event.
-            return []
-    elif (x.__class__.__name__ == 'Rest'):
-        return [] # rests don't contribute to an event representation
-    elif (x.__class__.__name__ == 'Seq'):
-        leftEvs = musicToMEvents(x.left, currentTime, currentInstrument)
-        rightEvs = musicToMEvents(x.right, currentTime+dur(x.left), currentInstrument)
-        return leftEvs + rightEvs # events can be concatenated, doesn't require sorting
-    elif (x.__class__.__name__ == 'Par'):
-        topEvs = musicToMEvents(x.top, currentTime, currentInstrument)
-        botEvs = musicToMEvents(x.bot, currentTime, currentInstrument)
-        return sorted(topEvs+botEvs, key=lambda e: e.eTime) # need to sort events by onset
-    elif (x.__class__.__name__ == 'Modify'):
-        if (x.mod.__class__.__name__ == 'Tempo'):
-            y = applyTempo(x)
-            return musicToMEvents(y, currentTime, currentInstrument)
-        elif (x.mod.__class__.__name__ == 'Instrument'):
-            return musicToMEvents(x.tree, currentTime, x.mod.patch)
-    else:
-        raise EuterpeaException("Unrecognized musical structure: "+str(x))
+        # interpret all tempo scaling factors on the way down
+        return (0, (-1, INST), treeTempo(x, tempo))
+    elif (x.mod.__class__.__name__ == 'Tempo'):
+        return (currentTime, currentInstrument, treeTempo(x, tempo))
+    elif (x.mod.__class__.__name__ == 'Instrument'):
+        return (currentTime, x.mod.patch, tempo)
+    return ctx
+
+def addMEventsTree(x, currentTime, currentInstrument, evs, durs, tempo, depth):
+    if depth > maxDepth: return addMEventsDeep(x, currentTime, currentInstrument, evs, durs, tempo)
+    t, inst, tp = eventContext(x, (currentTime, currentInstrument, tempo))
+    addMEventsTable[x.tree.__class__](x.tree, t, inst, evs, durs, tp, depth + 1)
+
+def addMEventsNote(x, currentTime, currentInstrument, evs, durs, tempo, depth):
+    noteEvent(x, currentTime, currentInstrument, tempo, evs)
+
+def addMEventsRest(x, currentTime, currentInstrument, evs, durs, tempo, depth):
+    pass # rests don't contribute to an event representation
+
+def addMEventsSeq(x, currentTime, currentInstrument, evs, durs, tempo, depth):
+    if depth > maxDepth: return addMEventsDeep(x, currentTime, currentInstrument, evs, durs, tempo)
+    l, r = x.left, x.right
+    depth += 1
+    addMEventsTable[l.__class__](l, currentTime, currentInstrument, evs, durs, tempo, depth)
+    rightTime = currentTime+tempoDurAt(l, tempo, durs, depth)
+    addMEventsTable[r.__class__](r, rightTime, currentInstrument, evs, durs, tempo, depth)
+
+def addMEventsPar(x, currentTime, currentInstrument, evs, durs, tempo, depth):
+    if depth > maxDepth: return addMEventsDeep(x, currentTime, currentInstrument, evs, durs, tempo)
+    t, b = x.top, x.bot
+    addMEventsTable[t.__class__](t, currentTime, currentInstrument, evs, durs, tempo, depth + 1)
+    addMEventsTable[b.__class__](b, currentTime, currentInstrument, evs, durs, tempo, depth + 1)
+
+addMEventsTable = Dispatch({'Music': addMEventsTree, 'Note': addMEventsNote, 'Rest': addMEventsRest,
+                            'Seq': addMEventsSeq, 'Par': addMEventsPar, 'Modify': addMEventsTree})
+
+def addMEventsDeep(x, currentTime, currentInstrument, evs, durs, tempo):
+    walk(addMEventsDeepTable, x, (currentTime, currentInstrument, tempo), (evs, durs))
+
+# The context is as for eventContext and the state is (evs, durs).
+
+def addMEventsDeepTree(x, ctx, state, work):
+    work.append((None, x.tree, eventContext(x, ctx)))
+
+def addMEventsDeepNote(x, ctx, state, work):
+    noteEvent(x, ctx[0], ctx[1], ctx[2], state[0])
+
+def addMEventsDeepSeq(x, ctx, state, work):
+    currentTime, currentInstrument, tempo = ctx
+    rightTime = currentTime+tempoDur(x.left, tempo, state[1])
+    work.append((None, x.right, (rightTime, currentInstrument, tempo)))
+    work.append((None, x.left, ctx))
+
+addMEventsDeepTable = Dispatch({'Music': addMEventsDeepTree, 'Note': addMEventsDeepNote, 'Rest': visitLeaf,
+                                'Seq': addMEventsDeepSeq, 'Par': visitPar, 'Modify': addMEventsDeepTree})
 
 
 # =================================================================
@@ -856,7 +1677,7 @@ def mEventsToOnOff(mevs):
                 MEventMidi(e.eTime+e.dur, OFF, e.pitch, e.vol, e.patch)]
     onOffs = []
     for e in mevs:
-        onOffs = onOffs + f(e)
+        onOffs.extend(f(e))
     return sorted(onOffs, key=lambda e: e.eTime)
 
 
@@ -1060,32 +1881,89 @@ def chordListToMusic(chords, defDur=0.25, defVol=100):
 
 # Remove zero-duration entities
 
-def removeZeros(x):
-    if (x.__class__.__name__ == 'Music'):
-        x.tree = removeZeros(x.tree)
-        return x
-    elif (x.__class__.__name__ == 'Note' or x.__class__.__name__ == 'Rest'):
-        return x # can't remove at this stage
-    elif (x.__class__.__name__ == 'Seq'):
-        x.left = removeZeros(x.left)
-        x.right = removeZeros(x.right)
-        if (dur(x.left) <= 0):
-            return x.right
-        elif(dur(x.right) <=0):
-            return x.left
-        else:
-            return x
-    elif (x.__class__.__name__ == 'Par'):
-        x.top = removeZeros(x.top)
-        x.bot = removeZeros(x.bot)
-        if (dur(x.top) <= 0):
-            return x.bot
-        elif(dur(x.bot) <=0):
-            return x.top
-        else:
-            return x
-    elif (x.__class__.__name__ == 'Modify'):
-        x.tree = removeZeros(x.tree)
-        return x
+# Removing zero-duration parts never changes the duration of what is left,
+# so one duration cache is shared by the whole traversal.
+
+def removeZeros(x, durs=None):
+    if durs is None: durs = newDurCache()
+    return removeZerosTable[x.__class__](x, durs, 0)
+
+def removeZerosTree(x, durs, depth):
+    if depth > maxDepth: return removeZerosDeep(x, durs)
+    t = x.tree
+    x.tree = removeZerosTable[t.__class__](t, durs, depth + 1)
+    return x
+
+def removeZerosLeaf(x, durs, depth): return x # can't remove at this stage
+
+# What replaces a Seq or Par x with parts a and b that have had their own
+# zeros removed.
+
+def withoutZeros(x, a, b, durs, depth):
+    if (durAt(a, durs, depth) <= 0):
+        return b
+    elif(durAt(b, durs, depth) <=0):
+        return a
     else:
-        raise EuterpeaException("Unrecognized musical structure: "+str(x))
\ No newline at end of file
+        return x
+
+def removeZerosSeq(x, durs, depth):
+    if depth > maxDepth: return removeZerosDeep(x, durs)
+    l, r = x.left, x.right
+    depth += 1
+    x.left = removeZerosTable[l.__class__](l, durs, depth)
+    x.right = removeZerosTable[r.__class__](r, durs, depth)
+    return withoutZeros(x, x.left, x.right, durs, depth)
+
+def removeZerosPar(x, durs, depth):
+    if depth > maxDepth: return removeZerosDeep(x, durs)
+    t, b = x.top, x.bot
+    depth += 1
+    x.top = removeZerosTable[t.__class__](t, durs, depth)
+    x.bot = removeZerosTable[b.__class__](b, durs, depth)
+    return withoutZeros(x, x.top, x.bot, durs, depth)
+
+removeZerosTable = Dispatch({'Music': removeZerosTree, 'Note': removeZerosLeaf, 'Rest': removeZerosLeaf,
+                             'Seq': removeZerosSeq, 'Par': removeZerosPar, 'Modify': removeZerosTree})
+
+def removeZerosDeep(x, durs):
+    vals = []
+    walk(removeZerosDeepTable, x, None, (vals, durs))
+    return vals[0]
+
+# As with applyTempoInPlace, what replaces each subtree is left on vals.
+
+def removeZerosDeepLeaf(x, ctx, state, work): state[0].append(x) # can't remove at this stage
+
+def removeZerosDeepTree(x, ctx, state, work):
+    work.append((removeZerosDeepTreeDone, x, ctx))
+    work.append((None, x.tree, ctx))
+
+def removeZerosDeepSeq(x, ctx, state, work):
+    work.append((removeZerosDeepSeqDone, x, ctx))
+    work.append((None, x.right, ctx))
+    work.append((None, x.left, ctx))
+
+def removeZerosDeepPar(x, ctx, state, work):
+    work.append((removeZerosDeepParDone, x, ctx))
+    work.append((None, x.bot, ctx))
+    work.append((None, x.top, ctx))
+
+def removeZerosDeepTreeDone(x, ctx, state, work):
+    x.tree = state[0].pop()
+    state[0].append(x)
+
+def removeZerosDeepSeqDone(x, ctx, state, work):
+    vals, durs = state
+    x.right = vals.pop()
+    x.left = vals.pop()
+    vals.append(withoutZeros(x, x.left, x.right, durs, 0))
+
+def removeZerosDeepParDone(x, ctx, state, work):
+    vals, durs = state
+    x.bot = vals.pop()
+    x.top = vals.pop()
+    vals.append(withoutZeros(x, x.top, x.bot, durs, 0))
+
+removeZerosDeepTable = Dispatch({'Music': removeZerosDeepTree, 'Note': removeZerosDeepLeaf, 'Rest': removeZerosDeepLeaf,
+                                 'Seq': removeZerosDeepSeq, 'Par': removeZerosDeepPar, 'Modify': removeZerosDeepTree})
@@ -1,6 +1,87 @@
+import heapq
+import multiprocessing
+import pickle
 import random
 import sys
+import time
 import QuotientSpaces
+import json
+from itertools import product
+
+# Optional instrumentation. While enableStats() is in effect, the searches
+# below count what they do (class lookups, candidates considered,
+# constraint calls, prunes, backtracks, fallbacks, ...) and time their
+# stages in the returned SearchStats. When stats are disabled (the
+# default), constraints are not wrapped and each counting point is a
+# single check of the module-level stats variable.
+stats = None
+
+class SearchStats:
+    def __init__(self):
+        self.counts = {}
+        self.times = {} # stage name -> total seconds
+    def count(self, name, n=1):
+        self.counts[name] = self.counts.get(name, 0) + n
+    def addTime(self, name, secs):
+        self.times[name] = self.times.get(name, 0.0) + secs
+    def toDict(self):
+        return {'counts': dict(self.counts), 'times': dict(self.times)}
+    def toJSON(self):
+        return json.dumps(self.toDict(), sort_keys=True)
+    def __str__(self):
+        return self.toJSON()
+    def __repr__(self):
+        return str(self)
+
+def enableStats():
+    global stats
+    stats = SearchStats()
+    return stats
+
+def disableStats():
+    global stats
+    s = stats
+    stats = None
+    return s
+
+class StageTimer:
+    def __init__(self, name):
+        self.name = name
+    def __enter__(self):
+        self.t0 = time.time()
+        return self
+    def __exit__(self, excType, excVal, tb):
+        if stats is not None:
+            stats.addTime(self.name, time.time() - self.t0)
+        return False
+
+class NoTimer:
+    def __enter__(self):
+        return self
+    def __exit__(self, excType, excVal, tb):
+        return False
+
+NO_TIMER = NoTimer()
+
+# with stage('name'): ... times a block when stats are enabled
+def stage(name):
+    if stats is None:
+        return NO_TIMER
+    return StageTimer(name)
+
+# Wraps fn to count its calls under name when stats are enabled. The
+# wrapper keeps the original as f.counted, so that a TransitionCache
+# still finds the same tables whether stats are on or off.
+def countCalls(fn, name='constraintCalls'):
+    if stats is None or fn is None:
+        return fn
+    s = stats
+    def f(*args):
+        s.count(name)
+        return fn(*args)
+    f.counted = fn
+    return f
+
 def nextSol(buckets, pre):
     code = None
     res = []
@@ -26,26 +107,52 @@ def nextSol(buckets, pre):
     return codes, res
 
 
+def findTargets(qspace, eqrel, bucket):
+    with stage('eqClass'):
+        targets = []
+        for val in bucket:
+            if hasattr(qspace, 'eqClass'): # e.g. a ChordSpaces.SharedChordSpace
+                tar = qspace.eqClass(eqrel, val)
+            else:
+                tar = QuotientSpaces.eqClass(qspace, eqrel, val)
+            if tar is None or len(tar) == 0:
+                raise Exception('error','No class for'+str(val))
+            targets.append(tar)
+        if stats is not None:
+            stats.count('eqClassLookups', len(targets))
+            stats.count('classMembers', sum(map(len, targets)))
+        return targets
+
 def allSols(qspace, eqrel, bucket):
-    targets = []
-    for val in bucket:
-        tar = QuotientSpaces.eqClass(qspace, eqrel, val)
-        if len(tar) == 0:
-            raise Exception('error','No class for'+str(val))
-        targets.append(tar)
-    return allSolsHelper(targets)
+    return allSolsHelper(findTargets(qspace, eqrel, bucket))
 
 def allSolsHelper(buckets):
+    return list(iterSolsHelper(buckets))
+
+# Lazy version of allSols. Solutions come out in the same order as
+# allSols (first bucket changes fastest). Stops after limit solutions
+# if a limit is given. With no buckets, the one solution is [].
+def iterSols(qspace, eqrel, bucket, limit=None):
+    return iterSolsHelper(findTargets(qspace, eqrel, bucket), limit)
+
+def iterSolsHelper(buckets, limit=None):
+    n = 0
+    for sol in product(*reversed(buckets)):
+        if limit is not None and n >= limit:
+            return
+        sol = list(sol)
+        sol.reverse()
+        yield sol
+        n += 1
+
+def countSols(qspace, eqrel, bucket):
+    return countSolsHelper(findTargets(qspace, eqrel, bucket))
+
+def countSolsHelper(buckets):
     num = 1
     for b in buckets:
         num *= len(b)
-    pre = None
-    res = []
-    for iter in range(num):
-        pre, cur  = nextSol(buckets, pre)
-        res.append(cur)
-    # print(res)
-    return res
+    return num
 
 class Predicate: # f(a) # f(a, b)
     def __init__(self, fn, single=False):
@@ -70,16 +177,42 @@ class Predicate: # f(a) # f(a, b)
                 if self.fn(arr[i2], arr[i2+1]) is False:
                     return False
         return True
-def pairProg(qspace, eqrel, constraint, bucket):
-    targets = []
-    for val in bucket:
-        tar = QuotientSpaces.eqClass(qspace, eqrel, val)
-        if len(tar) == 0:
-            raise Exception('error', 'No class for' + str(val))
-        targets.append(tar)
-    res = []
-    pairProgHelper(targets, constraint, 0, [], res)
-    return res
+# With a TransitionCache, the constraint is evaluated once per pair of
+# classes and the search follows the cached successor lists. Giving the
+# constraint a name lets the cache be saved and reused in later runs.
+def pairProg(qspace, eqrel, constraint, bucket, prune=False, cache=None, name=None):
+    constraint = countCalls(constraint)
+    targets = findTargets(qspace, eqrel, bucket)
+    with stage('pairProg'):
+        if prune:
+            targets, sizes = pruneBuckets(targets, constraint)
+        if cache is not None:
+            return list(iterCachedProg(targets, constraint, cache, name))
+        res = []
+        pairProgHelper(targets, constraint, 0, [], res)
+        return res
+
+def iterCachedProg(buckets, constraint, cache, name=None):
+    n = len(buckets)
+    if n == 0:
+        yield []
+        return
+    succs = [cache.successors(buckets[i], buckets[i+1], constraint, name) for i in range(n - 1)]
+    pre = [] # indices of the chords chosen so far
+    opts = [list(range(len(buckets[0])))] # opts[i]: candidates left for position i
+    while len(opts) > 0:
+        i = len(opts) - 1
+        if len(opts[i]) == 0:
+            opts.pop()
+            if len(pre) > 0:
+                pre.pop()
+            continue
+        j = opts[i].pop(0)
+        if i == n - 1:
+            yield [buckets[k][pre[k]] for k in range(n - 1)] + [buckets[i][j]]
+        else:
+            pre.append(j)
+            opts.append(list(succs[i][j]))
 
 def pairProgHelper(buckets, constraint, ith, pre, res):
     if ith == len(buckets):
@@ -88,6 +221,221 @@ def pairProgHelper(buckets, constraint, ith, pre, res):
     for candidate in buckets[ith]:
         if len(pre) == 0 or constraint(pre[-1], candidate) is True:
             pairProgHelper(buckets, constraint, ith + 1, pre + [candidate], res)
+        elif stats is not None:
+            stats.count('prunes')
+    if stats is not None:
+        stats.count('candidates', len(buckets[ith]))
+        stats.count('backtracks')
+
+# Arc consistency for a chain of buckets: a candidate is removed when it
+# has no compatible candidate in the bucket before it or the bucket after
+# it, and this is repeated until nothing changes (AC-3 on a chain). After
+# pruning, every remaining candidate is part of at least one solution, so
+# backtracking never explores dead ends, and an empty bucket means there
+# is no solution at all. Returns the pruned buckets and a list of
+# (size before, size after) for each position.
+def pruneBuckets(buckets, constraint):
+    pruned = [list(b) for b in buckets]
+    changed = True
+    while changed:
+        changed = False
+        for i in range(1, len(pruned)): # forward: needs a predecessor
+            prevs = pruned[i-1]
+            keep = [b for b in pruned[i] if any(constraint(a, b) is True for a in prevs)]
+            if len(keep) < len(pruned[i]):
+                if stats is not None:
+                    stats.count('arcPrunes', len(pruned[i]) - len(keep))
+                pruned[i] = keep
+                changed = True
+        for i in range(len(pruned) - 2, -1, -1): # backward: needs a successor
+            nexts = pruned[i+1]
+            keep = [a for a in pruned[i] if any(constraint(a, b) is True for b in nexts)]
+            if len(keep) < len(pruned[i]):
+                if stats is not None:
+                    stats.count('arcPrunes', len(pruned[i]) - len(keep))
+                pruned[i] = keep
+                changed = True
+    sizes = [(len(b), len(p)) for (b, p) in zip(buckets, pruned)]
+    return pruned, sizes
+
+def pruneTargets(qspace, eqrel, constraint, bucket):
+    return pruneBuckets(findTargets(qspace, eqrel, bucket), constraint)
+
+def pruneBucketsOrFail(buckets, constraint):
+    pruned, sizes = pruneBuckets(buckets, constraint)
+    for i in range(len(pruned)):
+        if len(pruned[i]) == 0:
+            raise Exception('error', 'No progressions satisfy the constraint at position '+str(i))
+    return pruned
+
+# Lazy version of pairProg. The current partial progression is kept in a
+# single list (no copying at every step) and only copied when a complete
+# solution is yielded. Solutions come out in the same order as pairProg.
+def iterPairProg(qspace, eqrel, constraint, bucket, limit=None):
+    return iterPairProgHelper(findTargets(qspace, eqrel, bucket), constraint, limit)
+
+def iterPairProgHelper(buckets, constraint, limit=None):
+    n = len(buckets)
+    if n == 0:
+        yield []
+        return
+    found = 0
+    pre = []
+    idx = [0] # idx[i] is the next candidate to try at position i
+    while len(idx) > 0:
+        i = len(idx) - 1
+        if idx[i] >= len(buckets[i]): # position i exhausted, backtrack
+            idx.pop()
+            if len(pre) > 0:
+                pre.pop()
+            continue
+        candidate = buckets[i][idx[i]]
+        idx[i] += 1
+        if i > 0 and constraint(pre[-1], candidate) is not True:
+            continue
+        if i == n - 1:
+            if limit is not None and found >= limit:
+                return
+            found += 1
+            yield pre + [candidate]
+        else:
+            pre.append(candidate)
+            idx.append(0)
+
+# Counts the solutions of pairProg without enumerating them. pairCounts
+# works backwards through the buckets: counts[i][j] is the number of valid
+# ways to finish a progression from buckets[i][j]. This takes O(n*k^2)
+# constraint calls and Python's integers don't overflow, so spaces with
+# far more solutions than could ever be listed can still be counted.
+def countPairProg(qspace, eqrel, constraint, bucket):
+    constraint = countCalls(constraint)
+    targets = findTargets(qspace, eqrel, bucket)
+    with stage('countPairProg'):
+        return countPairProgHelper(targets, constraint)
+
+def countPairProgHelper(buckets, constraint):
+    if len(buckets) == 0:
+        return 1
+    return sum(pairCounts(buckets, constraint)[0])
+
+def pairCounts(buckets, constraint):
+    if len(buckets) == 0:
+        return []
+    counts = [[1] * len(buckets[-1])]
+    for i in range(len(buckets) - 2, -1, -1):
+        nexts = buckets[i+1]
+        nextCounts = counts[-1]
+        cur = []
+        for a in buckets[i]:
+            c = 0
+            for k in range(len(nexts)):
+                if nextCounts[k] > 0 and constraint(a, nexts[k]) is True:
+                    c += nextCounts[k]
+            cur.append(c)
+        counts.append(cur)
+    counts.reverse()
+    return counts
+
+# Draws progressions uniformly at random from all of the solutions of
+# pairProg. The pairCounts table is built once (O(n*k^2) constraint calls)
+# and each sample then walks forward, picking each chord with probability
+# proportional to the number of ways to finish from it, which costs O(n*k)
+# per sample. Unlike greedyProg, this never needs a fallback: every
+# sample satisfies the constraint. An exception is raised if there are no
+# solutions at all.
+def sampleProgs(qspace, eqrel, constraint, bucket, num=1, rng=None):
+    constraint = countCalls(constraint)
+    targets = findTargets(qspace, eqrel, bucket)
+    with stage('sampleProgs'):
+        return sampleProgsHelper(targets, constraint, num, rng)
+
+def sampleProgsHelper(buckets, constraint, num=1, rng=None, counts=None):
+    if rng is None:
+        rng = random
+    if len(buckets) == 0:
+        return [[] for k in range(num)]
+    if counts is None:
+        counts = pairCounts(buckets, constraint)
+    total = sum(counts[0])
+    if total == 0:
+        raise Exception('error', 'No progressions satisfy the constraint')
+    sols = []
+    for k in range(num):
+        j = weightedIndex(counts[0], range(len(buckets[0])), total, rng)
+        sol = [buckets[0][j]]
+        for i in range(1, len(buckets)):
+            ok = [k2 for k2 in range(len(buckets[i]))
+                  if counts[i][k2] > 0 and constraint(sol[-1], buckets[i][k2]) is True]
+            j = weightedIndex(counts[i], ok, counts[i-1][j], rng)
+            sol.append(buckets[i][j])
+        sols.append(sol)
+    return sols
+
+# Picks one of the indices in inds with probability weights[i]/total,
+# where total is the sum of those weights. Uses integers throughout so
+# that huge counts don't lose precision.
+def weightedIndex(weights, inds, total, rng):
+    r = rng.randrange(total)
+    for i in inds:
+        r -= weights[i]
+        if r < 0:
+            return i
+    raise Exception('error', 'Weights do not add up to '+str(total))
+
+# Finds the single progression with the lowest total cost, where cost(a, b)
+# is the cost of moving from chord a to chord b (for example,
+# Constraints.euclideanDist). Pairs that fail the constraint are never
+# used, and a constraint of None allows every pair. This is dynamic
+# programming over the buckets (Viterbi), so it takes O(n*k^2)
+# cost/constraint calls for n buckets of size k rather than enumerating
+# every progression like pairProg. Returns None if no
+# progression satisfies the constraint.
+def optimalProg(qspace, eqrel, constraint, cost, bucket):
+    constraint = countCalls(constraint)
+    targets = findTargets(qspace, eqrel, bucket)
+    with stage('optimalProg'):
+        return optimalProgHelper(targets, constraint, cost)[1]
+
+# Returns (total cost, progression), or (None, None) if there is none.
+def optimalProgHelper(buckets, constraint, cost):
+    if len(buckets) == 0:
+        return 0, []
+    best = [0] * len(buckets[0]) # best[j]: cheapest path ending at buckets[i][j]
+    back = [] # back[i-1][j]: index of the previous chord on that path
+    for i in range(1, len(buckets)):
+        prevs = buckets[i-1]
+        newBest = []
+        ptrs = []
+        for cand in buckets[i]:
+            minV = None
+            minJ = -1
+            for j in range(len(prevs)):
+                if best[j] is None:
+                    continue
+                if constraint is not None and constraint(prevs[j], cand) is not True:
+                    continue
+                v = best[j] + cost(prevs[j], cand)
+                if minV is None or v < minV:
+                    minV = v
+                    minJ = j
+            newBest.append(minV)
+            ptrs.append(minJ)
+        best = newBest
+        back.append(ptrs)
+    minV = None
+    minJ = -1
+    for j in range(len(best)):
+        if best[j] is not None and (minV is None or best[j] < minV):
+            minV = best[j]
+            minJ = j
+    if minV is None:
+        return None, None
+    sol = [buckets[-1][minJ]]
+    for i in range(len(back) - 1, -1, -1):
+        minJ = back[i][minJ]
+        sol.append(buckets[i][minJ])
+    sol.reverse()
+    return minV, sol
 
 
 # def pairProg(buckets, c):
@@ -108,12 +456,430 @@ def pairProgHelper(buckets, constraint, ith, pre, res):
 #     else:
 #         return res
 
+# Beam search between greedyProg and optimalProg. Only the best width
+# partial progressions are kept at each step, scored by the total of
+# cost(a, b) over adjacent chords, and pairs failing the constraint are
+# never used. Since the cost only depends on adjacent chords, just the
+# cheapest partial progression ending on each chord is kept. This takes
+# O(n*width*k) cost/constraint calls; a larger width gets closer to the
+# optimum at a higher cost and width >= k gives the same result as
+# optimalProg. Returns None if every partial progression dies out.
+def beamProg(qspace, eqrel, constraint, cost, bucket, width=10):
+    constraint = countCalls(constraint)
+    targets = findTargets(qspace, eqrel, bucket)
+    with stage('beamProg'):
+        return beamProgHelper(targets, constraint, cost, width)[1]
+
+# Returns (total cost, progression), or (None, None) if there is none or
+# if the optional deadline (a time.time() value) passes first.
+def beamProgHelper(buckets, constraint, cost, width=10, deadline=None):
+    if len(buckets) == 0:
+        return 0, []
+    # A state is (total cost, index in the current bucket, previous state),
+    # so partial progressions share their prefixes instead of copying them.
+    beam = [(0, j, None) for j in range(min(width, len(buckets[0])))]
+    for i in range(1, len(buckets)):
+        if deadline is not None and time.time() > deadline:
+            return None, None
+        prevs = buckets[i-1]
+        bestAt = {}
+        for state in beam:
+            a = prevs[state[1]]
+            for j in range(len(buckets[i])):
+                b = buckets[i][j]
+                if constraint is not None and constraint(a, b) is not True:
+                    continue
+                v = state[0] + cost(a, b)
+                if j not in bestAt or v < bestAt[j][0]:
+                    bestAt[j] = (v, j, state)
+        if len(bestAt) == 0:
+            return None, None
+        beam = heapq.nsmallest(width, bestAt.values(), key=lambda st: (st[0], st[1]))
+    best = min(beam, key=lambda st: st[0])
+    sol = []
+    state = best
+    for i in range(len(buckets) - 1, -1, -1):
+        sol.append(buckets[i][state[1]])
+        state = state[2]
+    sol.reverse()
+    return best[0], sol
+
+# Anytime search for a latency budget. Returns the best progression found
+# within timeLimit seconds under the total of cost(a, b) over adjacent
+# chords, never using pairs that fail the constraint. Each round runs a
+# beam search with twice the width of the last one plus one random
+# restart, and polishes both with local repair (see repairProg). Once the
+# beam is as wide as the largest class, the beam search is exact, so the
+# result is proven optimal (or proven not to exist).
+class AnytimeResult:
+    def __init__(self, sol, cost, optimal, timedOut, rounds):
+        self.sol = sol # None if no progression was found
+        self.cost = cost
+        self.optimal = optimal # True if sol is known to be the best
+        self.timedOut = timedOut # True if the search was cut off
+        self.rounds = rounds
+    def __str__(self):
+        return ("AnytimeResult(cost="+str(self.cost)+", optimal="+str(self.optimal)+
+                ", timedOut="+str(self.timedOut)+", rounds="+str(self.rounds)+")")
+    def __repr__(self):
+        return str(self)
+
+def anytimeProg(qspace, eqrel, constraint, cost, bucket, timeLimit, rng=None):
+    deadline = time.time() + timeLimit
+    constraint = countCalls(constraint)
+    targets = findTargets(qspace, eqrel, bucket)
+    with stage('anytimeProg'):
+        return anytimeProgHelper(targets, constraint, cost, deadline, rng)
+
+def anytimeProgHelper(buckets, constraint, cost, deadline, rng=None):
+    if rng is None:
+        rng = random
+    best = [None, None] # [cost, progression]
+    def offer(sol):
+        if sol is not None:
+            sol = repairProg(buckets, sol, constraint, cost, deadline)
+            v = progCost(sol, cost)
+            if best[0] is None or v < best[0]:
+                best[0] = v
+                best[1] = sol
+    maxK = max([len(b) for b in buckets]) if len(buckets) > 0 else 0
+    width = 1
+    rounds = 0
+    while time.time() <= deadline:
+        rounds += 1
+        v, sol = beamProgHelper(buckets, constraint, cost, width, deadline)
+        if sol is None and time.time() > deadline:
+            break
+        if width >= maxK: # exact, so nothing left to improve
+            if sol is not None and (best[0] is None or v <= best[0]):
+                best[0] = v
+                best[1] = sol
+            return AnytimeResult(best[1], best[0], True, False, rounds)
+        offer(sol)
+        if time.time() > deadline:
+            break
+        offer(randomProg(buckets, constraint, rng, deadline))
+        width *= 2
+    return AnytimeResult(best[1], best[0], False, True, rounds)
+
+def progCost(sol, cost):
+    return sum([cost(sol[i], sol[i+1]) for i in range(len(sol) - 1)])
+
+# One random walk forward through the buckets that only takes chords
+# allowed by the constraint. Returns None if it gets stuck or the
+# deadline passes.
+def randomProg(buckets, constraint, rng, deadline=None):
+    sol = []
+    for b in buckets:
+        if deadline is not None and time.time() > deadline:
+            return None
+        can = b if len(sol) == 0 else [c for c in b if constraint(sol[-1], c) is True]
+        if len(can) == 0:
+            return None
+        sol.append(rng.choice(can))
+    return sol
+
+# Local repair: repeatedly re-voices single chords to the member of their
+# class that is cheapest given both neighbours, keeping the constraint
+# satisfied, until no single change helps or the deadline passes.
+def repairProg(buckets, sol, constraint, cost, deadline=None):
+    sol = list(sol)
+    n = len(sol)
+    improved = True
+    while improved:
+        improved = False
+        for i in range(n):
+            if deadline is not None and time.time() > deadline:
+                return sol
+            def local(c):
+                v = 0
+                if i > 0:
+                    v += cost(sol[i-1], c)
+                if i < n - 1:
+                    v += cost(c, sol[i+1])
+                return v
+            bestC = sol[i]
+            bestV = local(bestC)
+            for c in buckets[i]:
+                if i > 0 and constraint(sol[i-1], c) is not True:
+                    continue
+                if i < n - 1 and constraint(c, sol[i+1]) is not True:
+                    continue
+                v = local(c)
+                if v < bestV:
+                    bestC = c
+                    bestV = v
+            if bestC is not sol[i]:
+                sol[i] = bestC
+                improved = True
+    return sol
+
+# Min-conflicts local search for long progressions. Starts from a greedy
+# voicing and repeatedly re-voices a chord involved in the most violated
+# pairs, choosing the member of its class that violates the fewest pairs
+# with its neighbours (ties broken randomly). With probability noise, a
+# random conflicted chord gets a random voicing instead, which helps to
+# get off plateaus. Each step costs O(k) constraint calls no matter how
+# long the progression is. Returns the progression and the list of pair
+# positions i that still violate the constraint between sol[i] and
+# sol[i+1] (empty if the search succeeded).
+def minConflictsProg(qspace, eqrel, constraint, bucket, maxSteps=10000, noise=0.1, rng=None):
+    constraint = countCalls(constraint)
+    targets = findTargets(qspace, eqrel, bucket)
+    with stage('minConflictsProg'):
+        return minConflictsHelper(targets, constraint, maxSteps, noise, rng)
+
+def minConflictsHelper(buckets, constraint, maxSteps=10000, noise=0.1, rng=None, init=None):
+    if rng is None:
+        rng = random
+    n = len(buckets)
+    if init is None:
+        init = greedyProgHelper(buckets, constraint, lambda tar, pre: rng.choice(tar), rng)
+    sol = list(init)
+    violated = set(i for i in range(n - 1) if constraint(sol[i], sol[i+1]) is not True)
+    def conflicts(i, c):
+        v = 0
+        if i > 0 and constraint(sol[i-1], c) is not True:
+            v += 1
+        if i < n - 1 and constraint(c, sol[i+1]) is not True:
+            v += 1
+        return v
+    steps = 0
+    while len(violated) > 0 and steps < maxSteps:
+        steps += 1
+        if stats is not None:
+            stats.count('repairSteps')
+        counts = {}
+        for p in violated:
+            counts[p] = counts.get(p, 0) + 1
+            counts[p+1] = counts.get(p+1, 0) + 1
+        if rng.random() < noise:
+            i = rng.choice(list(counts.keys()))
+            c = rng.choice(buckets[i])
+        else:
+            most = max(counts.values())
+            i = rng.choice([j for j in counts if counts[j] == most])
+            bestV = None
+            bestCs = []
+            for c in buckets[i]:
+                v = conflicts(i, c)
+                if bestV is None or v < bestV:
+                    bestV = v
+                    bestCs = [c]
+                elif v == bestV:
+                    bestCs.append(c)
+            c = rng.choice(bestCs)
+        sol[i] = c
+        for p in (i - 1, i):
+            if 0 <= p < n - 1:
+                if constraint(sol[p], sol[p+1]) is True:
+                    violated.discard(p)
+                else:
+                    violated.add(p)
+    return sol, sorted(violated)
+
+# Segmented search for long progressions. The buckets are split into
+# segments, either at the given cut positions (for example, cadence
+# points) or every segLen chords, and each segment is solved on its own
+# with optimalProgHelper in a pool of worker processes. Each cut is then
+# stitched by re-solving a small window of chords around it with the
+# chords just outside the window held fixed, so that the constraint holds
+# across the cut. The window doubles in size until it works; if it grows
+# to cover everything and still fails, there is no solution and None is
+# returned. The constraint and cost must be picklable (top-level
+# functions, not lambdas) to be sent to the workers.
+def segmentedProg(qspace, eqrel, constraint, cost, bucket, segLen=16, cuts=None, processes=None, window=2):
+    targets = findTargets(qspace, eqrel, bucket)
+    with stage('segmentedProg'): # work done in other processes isn't counted
+        return segmentedProgHelper(targets, constraint, cost, segLen, cuts, processes, window)
+
+def zeroCost(a, b):
+    return 0
+
+def segmentWorker(args):
+    (buckets, constraint, cost) = args
+    return optimalProgHelper(buckets, constraint, cost)[1]
+
+def segmentedProgHelper(buckets, constraint, cost=zeroCost, segLen=16, cuts=None, processes=None, window=2):
+    n = len(buckets)
+    if cuts is None:
+        cuts = list(range(segLen, n, segLen))
+    cuts = sorted(set([c for c in cuts if 0 < c < n]))
+    bounds = list(zip([0] + cuts, cuts + [n]))
+    jobs = [(buckets[lo:hi], constraint, cost) for (lo, hi) in bounds]
+    if processes == 1 or len(jobs) <= 1:
+        parts = list(map(segmentWorker, jobs))
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            parts = pool.map(segmentWorker, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    sol = []
+    for part in parts:
+        if part is None: # a segment has no solution even on its own
+            return None
+        sol = sol + part
+    for c in cuts:
+        w = window
+        while True:
+            lo = max(0, c - w)
+            hi = min(n, c + w)
+            part = windowProg(buckets, sol, lo, hi, constraint, cost)
+            if part is not None:
+                sol[lo:hi] = part
+                break
+            if lo == 0 and hi == n:
+                return None
+            w *= 2
+    return sol
+
+# Best voicing of positions lo to hi-1 given the chords currently at lo-1
+# and hi (if those exist), or None if no voicing fits between them.
+def windowProg(buckets, sol, lo, hi, constraint, cost):
+    inner = buckets[lo:hi]
+    if lo > 0:
+        inner = [[sol[lo-1]]] + inner
+    if hi < len(buckets):
+        inner = inner + [[sol[hi]]]
+    part = optimalProgHelper(inner, constraint, cost)[1]
+    if part is None:
+        return None
+    if lo > 0:
+        part = part[1:]
+    if hi < len(buckets):
+        part = part[:-1]
+    return part
+
+# Incremental re-voicing for editing. An IncrementalProg keeps the
+# classes for each position and the current solution. When some chords
+# are replaced, only the new chords are looked up, and only a window
+# around the edit (with context extra chords on each side) is re-solved
+# with windowProg while the chords just outside it stay fixed. The window
+# grows only if the constraint can't be met at its edges, so the work
+# depends on the size of the edit rather than the length of the piece.
+class IncrementalProg:
+    def __init__(self, qspace, eqrel, constraint, cost=zeroCost, context=2):
+        self.qspace = qspace
+        self.eqrel = eqrel
+        self.constraint = constraint
+        self.cost = cost
+        self.context = context
+        self.lookups = {} # val -> class, so repeated chords are only looked up once
+        self.targets = []
+        self.sol = []
+        self.window = (0, 0)
+
+    def lookup(self, val):
+        key = tuple(val) if isinstance(val, list) else val
+        tar = self.lookups.get(key)
+        if tar is None:
+            tar = findTargets(self.qspace, self.eqrel, [val])[0]
+            self.lookups[key] = tar
+        return tar
+
+    def solve(self, bucket):
+        self.targets = [self.lookup(val) for val in bucket]
+        self.sol = optimalProgHelper(self.targets, self.constraint, self.cost)[1]
+        if self.sol is None:
+            self.sol = []
+            raise Exception('error', 'No progressions satisfy the constraint')
+        self.window = (0, len(self.sol))
+        return self.sol
+
+    # Replaces the chords at positions lo to hi-1 with vals (which may have
+    # a different length, so this also covers insertion and deletion) and
+    # returns the new solution.
+    def replace(self, lo, hi, vals):
+        newTargets = [self.lookup(val) for val in vals]
+        k = len(newTargets)
+        oldTargets = self.targets[lo:hi] # only the edited part is kept for undoing
+        oldSol = self.sol[lo:hi]
+        self.targets[lo:hi] = newTargets
+        self.sol[lo:hi] = [None] * k
+        n = len(self.targets)
+        w = self.context
+        while True:
+            wlo = max(0, lo - w)
+            whi = min(n, lo + k + w)
+            part = windowProg(self.targets, self.sol, wlo, whi, self.constraint, self.cost)
+            if part is not None:
+                self.sol[wlo:whi] = part
+                self.window = (wlo, whi) # the positions that may have changed
+                return self.sol
+            if wlo == 0 and whi == n: # leave the previous solution in place
+                self.targets[lo:lo+k] = oldTargets
+                self.sol[lo:lo+k] = oldSol
+                raise Exception('error', 'No progressions satisfy the constraint')
+            w = 2 * w if w > 0 else 1
+
+    def insert(self, pos, vals):
+        return self.replace(pos, pos, vals)
+
+    def delete(self, lo, hi):
+        return self.replace(lo, hi, [])
+
+# Caches transition tables between pairs of classes. Real progressions
+# repeat the same few class transitions (like V to I) many times, so each
+# table is computed in bulk the first time a pair of classes is seen and
+# reused after that. Tables are keyed by the contents of both classes and
+# by the constraint/cost function, or by a name for it if one is given.
+# Only tables with names can be saved to and loaded from a file, since
+# functions can't be identified across runs.
+class TransitionCache:
+    def __init__(self):
+        self.tables = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Keys are built from the contents of a class every time rather than
+    # remembered by id, which would keep every class list ever seen alive.
+    def classKey(self, cls):
+        return tuple(tuple(c) if isinstance(c, list) else c for c in cls)
+
+    def lookup(self, kind, cls1, cls2, fn, name, build):
+        if name is None:
+            name = getattr(fn, 'counted', fn) # see countCalls
+        key = (kind, self.classKey(cls1), self.classKey(cls2), name)
+        table = self.tables.get(key)
+        if table is None:
+            self.misses += 1
+            table = build()
+            self.tables[key] = table
+        else:
+            self.hits += 1
+        return table
+
+    # succ[i] lists the indices j for which constraint(cls1[i], cls2[j]) holds
+    def successors(self, cls1, cls2, constraint, name=None):
+        def build():
+            return [[j for j in range(len(cls2)) if constraint(a, cls2[j]) is True] for a in cls1]
+        return self.lookup('succ', cls1, cls2, constraint, name, build)
+
+    # costs[i][j] is cost(cls1[i], cls2[j])
+    def costs(self, cls1, cls2, cost, name=None):
+        def build():
+            return [[cost(a, b) for b in cls2] for a in cls1]
+        return self.lookup('cost', cls1, cls2, cost, name, build)
+
+    def save(self, filename):
+        named = dict((k, v) for (k, v) in self.tables.items() if isinstance(k[3], str))
+        with open(filename, 'wb') as f:
+            pickle.dump(named, f, pickle.HIGHEST_PROTOCOL)
+
+    def load(self, filename):
+        with open(filename, 'rb') as f:
+            self.tables.update(pickle.load(f))
+        return self
+
 class Fallback:
-    def __init__(self, fn = None):
+    def __init__(self, fn = None, rng = None):
         self.fn = fn
+        self.rng = rng if rng is not None else random
     def gen(self, bucket, pre = None):
         if self.fn is None or pre is None:
-            return random.choice(bucket)
+            return self.rng.choice(bucket)
         return self.fn(bucket, pre)
 # def greedyProg(buckets, fallback, c):
 #     sol = []
@@ -140,12 +906,51 @@ class Fallback:
 #             pre = fallback.gen(buckets[idx], pre)
 #         sol.append(pre)
 #     return sol
-def greedyProg(qspace, eqrel, constraint, fallback, bucket):
+# With prune=True, the classes are first made arc consistent (see
+# pruneBuckets), so the greedy walk can never get stuck and the fallback
+# is never needed. An exception is raised if there is no solution.
+#
+# The rng arguments here and elsewhere in this file take a random.Random
+# to make results reproducible per seed and safe to run in several
+# threads at once. They default to the global random module.
+def greedyProg(qspace, eqrel, constraint, fallback, bucket, prune=False, cache=None, rng=None, name=None):
+    constraint = countCalls(constraint)
+    targets = findTargets(qspace, eqrel, bucket)
+    with stage('greedyProg'):
+        if prune:
+            targets = pruneBucketsOrFail(targets, constraint)
+        if cache is not None:
+            return greedyCachedProg(targets, constraint, fallback, cache, rng, name)
+        return greedyProgHelper(targets, constraint, fallback, rng)
+
+def greedyCachedProg(buckets, constraint, fallback, cache, rng=None, name=None):
+    if rng is None:
+        rng = random
+    sol = []
+    preJ = None
+    for idx in range(len(buckets)):
+        tar = buckets[idx]
+        if idx == 0:
+            can = list(range(len(tar)))
+        else:
+            can = cache.successors(buckets[idx-1], tar, constraint, name)[preJ]
+        if len(can) == 0:
+            if stats is not None:
+                stats.count('fallbacks')
+            pre = fallback(tar, sol[-1])
+            preJ = tar.index(pre)
+        else:
+            preJ = rng.choice(can)
+        sol.append(tar[preJ])
+    return sol
+
+def greedyProgHelper(buckets, constraint, fallback, rng=None):
+    if rng is None:
+        rng = random
     sol = []
     pre = None
-    for idx in range(len(bucket)):
-        val = bucket[idx]
-        tar = QuotientSpaces.eqClass(qspace, eqrel, val)
+    for idx in range(len(buckets)):
+        tar = buckets[idx]
         can = []
         if idx != 0:
             for t in tar:
@@ -153,22 +958,103 @@ def greedyProg(qspace, eqrel, constraint, fallback, bucket):
                     can.append(t)
         else:
             can = tar
+        if stats is not None:
+            stats.count('candidates', len(tar))
         if len(can) == 0:
+            if stats is not None:
+                stats.count('fallbacks')
             pre = fallback(tar, pre)
         else:
-            pre = random.choice(can)
+            pre = rng.choice(can)
         sol.append(pre)
     return sol
 def nearFall(bucket, pre):
     # abs(i - pre)
-    minV = sys.maxint
-    minAbs = sys.maxint
+    minV = sys.maxsize
+    minAbs = sys.maxsize
     for val in bucket:
         if abs(val - pre) < minAbs:
             minAbs = abs(val - pre)
             minV = val
     return minV
 
+# Nearest-neighbour index over one class of chords (lists of numbers of
+# the same length; plain numbers are treated as 1-voice chords). This is
+# a k-d tree, built once in O(k log k), and a query typically visits
+# O(log k) nodes. The distance is either "euclidean" or "maxstep" (the
+# largest distance moved by any voice, as in Constraints.maxStepDist).
+EUCLIDEAN = "euclidean"
+MAXSTEP = "maxstep"
+
+class NearestIndex:
+    def __init__(self, chords, dist=EUCLIDEAN):
+        if dist != EUCLIDEAN and dist != MAXSTEP:
+            raise Exception('error', 'Unknown distance: '+str(dist))
+        self.chords = chords
+        self.dist = dist
+        self.points = [c if isinstance(c, (list, tuple)) else [c] for c in chords]
+        self.dim = len(self.points[0]) if len(self.points) > 0 else 0
+        self.root = self.build(list(range(len(self.points))), 0)
+
+    # A node is (index of its point, split axis, left subtree, right subtree)
+    def build(self, inds, depth):
+        if len(inds) == 0:
+            return None
+        axis = depth % self.dim if self.dim > 0 else 0
+        inds.sort(key=lambda i: self.points[i][axis] if self.dim > 0 else 0)
+        mid = len(inds) // 2
+        return (inds[mid], axis, self.build(inds[:mid], depth + 1), self.build(inds[mid + 1:], depth + 1))
+
+    # Squared distance for euclidean so that no square roots are needed
+    def distance(self, p, q):
+        if self.dist == EUCLIDEAN:
+            return sum([(a - b) ** 2 for (a, b) in zip(p, q)])
+        return max([abs(a - b) for (a, b) in zip(p, q)]) if len(p) > 0 else 0
+
+    def nearest(self, x):
+        if self.root is None:
+            return None
+        q = x if isinstance(x, (list, tuple)) else [x]
+        best = [None, None] # [distance, index]
+        stack = [(0, self.root)] # (lower bound on the distance, subtree)
+        while len(stack) > 0:
+            (lower, node) = stack.pop()
+            if node is None:
+                continue
+            if best[0] is not None and lower >= best[0]: # nothing closer in there
+                continue
+            (i, axis, left, right) = node
+            d = self.distance(q, self.points[i])
+            if best[0] is None or d < best[0]:
+                best[0] = d
+                best[1] = i
+            if self.dim == 0:
+                continue
+            diff = q[axis] - self.points[i][axis]
+            near, far = (left, right) if diff < 0 else (right, left)
+            bound = diff * diff if self.dist == EUCLIDEAN else abs(diff)
+            stack.append((max(lower, bound), far)) # checked again when popped
+            stack.append((lower, near)) # popped first
+        return self.chords[best[1]]
+
+# A fallback for greedyProg that returns the chord in the class nearest to
+# the previous chord, using a NearestIndex that is built the first time
+# each class is seen and reused after that.
+class NearFallback:
+    def __init__(self, dist=EUCLIDEAN, rng=None):
+        self.dist = dist
+        self.rng = rng if rng is not None else random
+        self.indexes = {} # id(class) -> (class, index); keeps the class alive
+
+    def __call__(self, bucket, pre):
+        entry = self.indexes.get(id(bucket))
+        if entry is None or entry[0] is not bucket:
+            entry = (bucket, NearestIndex(bucket, self.dist))
+            self.indexes[id(bucket)] = entry
+        if pre is None:
+            return self.rng.choice(bucket)
+        return entry[1].nearest(pre)
+
 # # for testing:
 # A = [1, 2]
 # B = [3, 4]